@@ -1,13 +1,17 @@
 """
 Raduga cloud manager
+
+Importing this module is kept cheap, so that commands start fast: boto,
+cloudcast and pkg_resources are only imported by the actions that use them.
 """
 
 from raduga.aws import Target
-from raduga.aws.ec2 import AWSEC2
-from raduga.aws.cfn import AWSCfn
-from raduga.distmgr import DistributionsManager
+from raduga.scheduler import BuildScheduler, DependencyGraph
+from raduga.render import RenderedStack, TemplateCache, FingerprintStore, find_module_path, sources_fingerprint
 
-from cloudcast.iscm.phased import PURPOSE_BUILD, PURPOSE_RUN
+def get_version():
+    import pkg_resources
+    return pkg_resources.require("raduga")[0].version
 
 class Environment(object):
     def __init__(self, **kwargs):
@@ -30,15 +34,93 @@ class Environment(object):
         #
         return ret
 
+import os, os.path
 from contextlib import contextmanager
+from threading import Lock
+from multiprocessing.pool import ThreadPool
+
+def _render_worker(raduga, names, apply_amis, conn):
+    """
+    Body of a worker process rendering stacks. Sends back ("ok", rendered
+    stacks) or ("error", description of the error) through conn.
+    """
+    import traceback
+    for target in raduga.targets.values():
+        target.reset_connections()
+    try:
+        result = ("ok", raduga._render_group(names, apply_amis))
+    except Exception as e:
+        traceback.print_exc()
+        result = ("error", "%s: %s" % (e.__class__.__name__, str(e)))
+    conn.send(result)
+    conn.close()
+
+def _fetch_templates_worker(raduga, names, jobs, conn):
+    """
+    Body of the process fetching the deployed templates of stacks, with
+    jobs threads. Sends back ("ok", dictionary stack -> template) or
+    ("error", description of the error) through conn.
+    """
+    import traceback
+    from raduga.aws.cfn import AWSCfn
+    for target in raduga.targets.values():
+        target.reset_connections()
+    cfn = AWSCfn(raduga.targets["aws"])
+    pool = ThreadPool(jobs)
+    try:
+        templates = pool.map(cfn.get_deployed_template, [ raduga._stack_names[name] for name in names ])
+        result = ("ok", dict(zip(names, templates)))
+    except Exception as e:
+        traceback.print_exc()
+        result = ("error", "%s: %s" % (e.__class__.__name__, str(e)))
+    finally:
+        pool.terminate()
+        pool.join()
+    conn.send(result)
+    conn.close()
+
+# States of build targets while their build stack is up
+_BUILD_STACK_STATES = ('cfn_state_check', 'cfn_creation_check', 'cfn_failure_check',
+                       'check_instance_state', 'check_ami_state', 'cfn_cleanup')
+
 class Raduga(object):
     def __init__(self):
         self.env = Environment()
         self.stacks = {}
         self.targets = {}
         self.req_modules = []
-        self.distmgr = DistributionsManager()
+        self._distmgr = None
         self._stack_names = {}
+        self.build_options = dict(
+            max_running_stacks = 8,     # build stacks running at the same time
+            workers = 8,                # threads advancing build targets
+            min_poll_interval = 2,      # seconds between polls of a waiting target ...
+            max_poll_interval = 30      # ... growing up to this
+        )
+        self.deploy_options = dict(
+            jobs = 1,                   # stacks being deployed at the same time
+            min_poll_interval = 2,      # seconds between checks of stacks being waited for ...
+            max_poll_interval = 30,     # ... growing up to this while nothing changes
+            show_events = True          # print the events of stacks being waited for
+        )
+        self.render_options = dict(
+            processes = None            # worker processes rendering stacks, None for one per cpu
+        )
+        self.use_template_cache = False     # reuse renderings cached on disk
+        self._template_cache = TemplateCache(os.path.join(os.getcwd(), ".raduga", "cache", "templates"))
+        self._fingerprints = FingerprintStore(os.path.join(os.getcwd(), ".raduga", "fingerprints.json"))
+        self._path_fingerprints = {}    # path -> sources fingerprint, taken once per run
+        self._build_lock = Lock()
+        self._ami_index = None
+        self._build_stack_index = None
+
+    @property
+    def distmgr(self):
+        # Created on first use, as it scans the modules folder
+        if self._distmgr is None:
+            from raduga.distmgr import DistributionsManager
+            self._distmgr = DistributionsManager()
+        return self._distmgr
 
     def addStack(self, name, **stack_desc):
         self.stacks[name] = stack_desc
@@ -53,6 +135,24 @@ class Raduga(object):
     def setRequiredModules(self, reqs):
         self.req_modules = reqs
 
+    def setDeployOptions(self, **options):
+        for k in options.keys():
+            if not self.deploy_options.has_key(k):
+                raise RuntimeError("Unknown deploy option %s" % k)
+        self.deploy_options.update(options)
+
+    def setBuildOptions(self, **options):
+        for k in options.keys():
+            if not self.build_options.has_key(k):
+                raise RuntimeError("Unknown build option %s" % k)
+        self.build_options.update(options)
+
+    def setRenderOptions(self, **options):
+        for k in options.keys():
+            if not self.render_options.has_key(k):
+                raise RuntimeError("Unknown render option %s" % k)
+        self.render_options.update(options)
+
     # ---- actions and helpers
 
     @contextmanager
@@ -65,9 +165,8 @@ class Raduga(object):
             mod = __import__(class_module, globals(), locals(), [ class_name ], 0)
             return getattr(mod, class_name)
         #
-        with self.distmgr.requirement_loader(*self.req_modules):
-            stack_env = stack_desc['env'] if stack_desc.has_key('env') else {}
-            environ = self.env.getEnvForStack(stack_name, _this_stack_name=self._stack_names[stack_name], _stack_names=self._stack_names, **stack_env)
+        with self.distmgr.requirement_loader(*self._stack_requirements(stack_desc)):
+            environ = self._stack_environ(stack_name, stack_desc)
             if stack_desc.has_key('stack_class'):
                 stack = stack_desc['stack_class'](environ)
             elif stack_desc.has_key('stack_class_name'):
@@ -77,12 +176,235 @@ class Raduga(object):
             yield stack
         #
 
-    def _find_ami_for_launchable(self, l, purpose=PURPOSE_RUN):
+    def _stack_requirements(self, stack_desc):
+        """
+        Module requirements of a stack: the global ones, overriden by the
+        ones in the stack description (if any)
+        """
+        return list(self.req_modules) + list(stack_desc.get('req_modules', []))
+
+    def _group_by_requirements(self, stacks):
+        """
+        Returns the stacks ordered so that stacks with the same requirements
+        are together, and can share loaded modules
+        """
+        keys = dict((name, sorted(self._stack_requirements(self.stacks[name]))) for name in stacks)
+        return sorted(stacks, key=lambda name: keys[name])
+
+    def _render_tasks(self, stacks, processes):
+        """
+        Splits the stacks into lists of stacks with the same requirements,
+        small enough for the work to be spread over the given processes
+        """
+        from itertools import groupby
+        chunk_size = max(1, -(-len(stacks) // processes))
+        tasks = []
+        reqs_of = lambda name: sorted(self._stack_requirements(self.stacks[name]))
+        for (_, group) in groupby(self._group_by_requirements(stacks), reqs_of):
+            group = list(group)
+            tasks.extend(group[i:i + chunk_size] for i in range(0, len(group), chunk_size))
+        return tasks
+
+    def _render_group(self, names, apply_amis):
+        """
+        Renders stacks with the same requirements, returns dictionary
+        stack -> rendered stack as a dictionary
+        """
+        with self.distmgr.shared_loading():
+            return dict((name, self._render_stack(name, self.stacks[name], apply_amis).to_dict()) for name in names)
+
+    def _render_stacks(self, stacks, apply_amis=True):
+        """
+        Renders the given stacks, returns dictionary stack -> RenderedStack.
+        Stacks are rendered in a pool of worker processes, each one taking
+        stacks with the same requirements, so that modules are loaded in
+        isolation from this process and from other requirements.
+        """
+        import time
+        from multiprocessing import Process, Pipe, cpu_count
+        processes = self.render_options['processes'] or cpu_count()
+        tasks = self._render_tasks(stacks, processes)
+        if processes <= 1 or len(tasks) <= 1:
+            rendered = {}
+            with self.distmgr.shared_loading():
+                for name in self._group_by_requirements(stacks):
+                    rendered[name] = self._render_stack(name, self.stacks[name], apply_amis)
+            return rendered
+        # Work that every worker would repeat is done before forking them:
+        # resolving requirements (also updates the lock file) and indexing AMIs
+        for names in tasks:
+            self.distmgr.resolve_requirements(*self._stack_requirements(self.stacks[names[0]]))
+        if apply_amis and self.targets.has_key("aws"):
+            self._get_ec2()
+        # Fresh worker process for each task, so that nothing loaded for some
+        # requirements remains for the next ones. Results come back through a
+        # pipe per worker, so that a worker dying without a result is noticed
+        pending = list(tasks)
+        running = []        # (process, parent end of the pipe, stacks)
+        rendered = {}
+        try:
+            while len(pending) > 0 or len(running) > 0:
+                while len(pending) > 0 and len(running) < processes:
+                    names = pending.pop(0)
+                    (parent_conn, child_conn) = Pipe(duplex=False)
+                    p = Process(target=_render_worker, args=(self, names, apply_amis, child_conn))
+                    p.start()
+                    child_conn.close()
+                    running.append((p, parent_conn, names))
+                progress = False
+                for (p, conn, names) in list(running):
+                    if not conn.poll() and p.is_alive():
+                        continue
+                    try:
+                        (status, result) = conn.recv()
+                    except EOFError:
+                        p.join()
+                        raise RuntimeError("Worker rendering stack(s) %s died (exit code %s)" % (", ".join(names), p.exitcode))
+                    p.join()
+                    conn.close()
+                    running.remove((p, conn, names))
+                    progress = True
+                    if status != "ok":
+                        raise RuntimeError("Rendering stack(s) %s failed: %s" % (", ".join(names), result))
+                    for (name, d) in result.items():
+                        rendered[name] = RenderedStack.from_dict(d)
+                if not progress:
+                    time.sleep(0.05)
+        finally:
+            for (p, conn, _) in running:
+                p.terminate()
+                p.join()
+                conn.close()
+        return rendered
+
+    def _stack_environ(self, stack_name, stack_desc):
+        stack_env = stack_desc['env'] if stack_desc.has_key('env') else {}
+        return self.env.getEnvForStack(stack_name, _this_stack_name=self._stack_names[stack_name], _stack_names=self._stack_names, **stack_env)
+
+    def _render_inputs(self, module_path, stack_desc):
+        """
+        Files and folders a stack may read when rendered: the whole project
+        folder, the package of the stack module if it lives elsewhere, and
+        any other inputs declared with "render_inputs" in the description
+        """
+        project = os.getcwd()
+        inputs = [ project ] + list(stack_desc.get('render_inputs', []))
+        if not os.path.abspath(module_path).startswith(project + os.sep):
+            inputs.append(module_path)
+        return inputs
+
+    def _sources_fingerprint(self, paths):
+        """
+        Fingerprint of the sources in the given paths. Each path is only
+        walked once per run, as all the stacks share the project folder.
+        """
+        import hashlib
+        h = hashlib.sha256()
+        for path in sorted(set(os.path.abspath(p) for p in paths)):
+            if not self._path_fingerprints.has_key(path):
+                self._path_fingerprints[path] = sources_fingerprint([ path ])
+            h.update("%s %s\n" % (path, self._path_fingerprints[path]))
+        return h.hexdigest()
+
+    def _render_cache_key(self, stack_name, stack_desc):
+        """
+        Returns key capturing everything the rendering of a stack depends on:
+        stack class, versions of the required modules, source files (see
+        _render_inputs), stack environment and region. None if the source of
+        the stack can't be found.
+        """
+        import hashlib, json, sys
+        dists = self.distmgr.resolve_requirements(*self._stack_requirements(stack_desc))
+        if stack_desc.has_key('stack_class'):
+            cls = stack_desc['stack_class']
+            class_path = "%s.%s" % (cls.__module__, cls.__name__)
+            module_path = getattr(sys.modules.get(cls.__module__), '__file__', None)
+        else:
+            class_path = stack_desc['stack_class_name']
+            module_path = find_module_path(class_path.split(".")[0], [ d.location for d in dists ] + sys.path)
+        if module_path is None:
+            return None
+        h = hashlib.sha256()
+        h.update(class_path + "\n")
+        for d in sorted(dists, key=lambda d: d.project_name):
+            h.update("%s %s %s %d\n" % (d.project_name, d.version, d.location, os.stat(d.location).st_mtime))
+        h.update(self._sources_fingerprint(self._render_inputs(module_path, stack_desc)) + "\n")
+        h.update(json.dumps(self._stack_environ(stack_name, stack_desc), sort_keys=True, default=repr) + "\n")
+        h.update(str(self.targets.has_key("aws") and self.targets["aws"].get_region() or None))
+        return h.hexdigest()
+
+    def _describe_buildables(self, stack):
+        """
+        Describes the buildable launchables of a stack, as much as needed to
+        find out the AMIs built for them. None if there's no target region.
+        """
+        from cloudcast.iscm.phased import PURPOSE_RUN
+        if not self.targets.has_key("aws"):
+            return None
+        region = self.targets["aws"].get_region()
+        buildables = filter(lambda l: l.is_buildable(), stack.get_launchable_resources())
+        return [ dict(
+            ref_name = l.ref_name,
+            base_ami = l.resolve_ami(region=region),
+            status_ids = [ b['status_id'] for b in l.iscm.get_possible_builds(PURPOSE_RUN) ]
+        ) for l in buildables ]
+
+    def _has_built_amis(self, rendered):
+        """
+        Tells whether any of the buildable launchables in a rendered stack
+        has an AMI built for it
+        """
+        if rendered.launchables is None:
+            return True     # can't tell
+        ec2 = self._get_ec2()
+        for l in rendered.launchables:
+            for status_id in l['status_ids']:
+                if status_id != "" and ec2.find_ami(base_ami=l['base_ami'], target_id=status_id) is not None:
+                    return True
+        return False
+
+    def _render_stack(self, name, desc, apply_amis=True):
+        """
+        Returns the stack rendered, with its buildable launchables set to run
+        the AMIs built for them if apply_amis. Renderings are cached on disk;
+        cached ones are used as long as there are no built AMIs to apply.
+        """
+        key = None
+        if self.use_template_cache:
+            key = self._render_cache_key(name, desc)
+        if key is not None:
+            rendered = self._template_cache.get(key)
+            if rendered is not None and (not apply_amis or not self._has_built_amis(rendered)):
+                return rendered
+        with self._load_stack(name, desc) as stack:
+            rendered = RenderedStack.from_stack(stack, self._describe_buildables(stack))
+            if key is not None:
+                self._template_cache.put(key, rendered)
+            if apply_amis and self._has_built_amis(rendered):
+                self._apply_built_amis(stack)
+                rendered = RenderedStack.from_stack(stack, rendered.launchables)
+            return rendered
+
+    def _get_ec2(self):
+        """
+        Returns EC2 helper sharing the AMI index of this run. The index is
+        built on first use, with a single listing of our AMIs.
+        """
+        from raduga.aws.ec2 import AWSEC2
+        with self._build_lock:
+            if self._ami_index is None:
+                ec2 = AWSEC2(self.targets["aws"])
+                self._ami_index = ec2.index_amis()
+                return ec2
+        return AWSEC2(self.targets["aws"], ami_index=self._ami_index)
+
+    def _find_ami_for_launchable(self, l, purpose):
         """
         This helper method helps to find the most suitable ami for a launchable
         resource, taking into account previously built amis
         """
-        ec2 = AWSEC2(self.targets["aws"])
+        from cloudcast.iscm.phased import PURPOSE_BUILD, PURPOSE_RUN
+        ec2 = self._get_ec2()
         region = self.targets["aws"].get_region()
         # Compute all possible builds for the launchable configuration
         iscm_builds = l.iscm.get_possible_builds(purpose)
@@ -125,11 +447,106 @@ class Raduga(object):
         build_stack.fix_broken_references()
         return build_stack
 
-    def _build_state_machine(self, build_target):
-        from time import sleep
-        #
+    def _print_stack_events(self, label, tailer):
+        """ Prints the events of a stack since they were last printed """
+        for e in tailer.poll():
+            print "  [%s] %s %s %s %s" % (label, e['timestamp'], e['logical_resource_id'],
+                e['resource_status'], e.get('resource_status_reason') or "")
+
+    def _acquire_stack_slot(self):
+        with self._build_lock:
+            if self._running_stacks >= self.build_options['max_running_stacks']:
+                return False
+            self._running_stacks += 1
+            return True
+
+    def _take_stack_slot(self):
+        with self._build_lock:
+            self._running_stacks += 1
+
+    def _release_stack_slot(self):
+        with self._build_lock:
+            self._running_stacks -= 1
+
+    def _get_build_stack_index(self):
+        """
+        Returns index of the build stacks by base_ami and target_id. The index
+        is built on first use, with a single listing of the stacks.
+        """
+        from raduga.aws.cfn import AWSCfn
+        with self._build_lock:
+            if self._build_stack_index is None:
+                self._build_stack_index = AWSCfn(self.targets["aws"]).index_stacks('base_ami', 'target_id')
+            return self._build_stack_index
+
+    def _resume_build_targets(self, build_targets, recorded):
+        """
+        Puts the build targets back in the states recorded in the journal.
+        Recorded targets that are not pending anymore, but have a build stack
+        around, are resumed as well, so that their stacks are cleaned up.
+        Targets that were about to launch their build stack start over.
+        """
+        from raduga.aws.cfn import AWSCfn
+        cfn = AWSCfn(self.targets["aws"])
+        for (target_id, rec) in recorded.items():
+            if build_targets.has_key(target_id):
+                target = build_targets[target_id]['target']
+            elif rec['state'] in _BUILD_STACK_STATES or rec['state'] == 'done':
+                target = dict(target_id=target_id, stack_name=rec['stack_name'],
+                    base_ami=rec['base_ami'], last_phase=rec['last_phase'])
+            else:
+                continue
+            bt = { "target": target, "state": rec['state'] }
+            for k in ('result', 'instance_id', 'ami_id', 'error'):
+                if rec[k] is not None:
+                    bt[k] = rec[k]
+            if rec['stack_id'] is not None:
+                bt['cfn_stack'] = cfn.AWSStack(rec['stack_id'])
+            if rec['state'] == 'cfn_launch_ready':
+                # The build stack may have been launched without the journal
+                # knowing, start over so that it's found if it was
+                bt['state'] = 'initial'
+            if rec['state'] in _BUILD_STACK_STATES:
+                self._take_stack_slot()     # count towards limits
+            build_targets[target_id] = bt
+
+    def _build_snapshot(self, build_targets):
+        """
+        Resolves, in one go, the status of every stack, instance and AMI that
+        the given build targets are waiting on
+        """
+        stack_ids = [ bt['cfn_stack'].stack_id for bt in build_targets
+                      if bt['state'] in ('cfn_state_check', 'cfn_creation_check', 'cfn_failure_check') ]
+        instance_ids = [ bt['instance_id'] for bt in build_targets if bt['state'] == 'check_instance_state' ]
+        image_ids = [ bt['ami_id'] for bt in build_targets if bt['state'] == 'check_ami_state' ]
+        from raduga.aws.poll import StatusSnapshot
+        return StatusSnapshot(self.targets["aws"],
+            stack_ids=stack_ids, instance_ids=instance_ids, image_ids=image_ids)
+
+    def _build_step(self, build_target, snapshot):
+        """
+        Advances a build target through the state machine. Errors are
+        contained to the target, so that other targets keep building.
+        """
+        try:
+            return self._build_state_machine(build_target, snapshot)
+        except Exception as e:
+            print "[ERROR] build target %s failed in state '%s': %s" % \
+                (build_target['target']['target_id'], build_target['state'], str(e))
+            build_target['result'] = 'FAILED'
+            build_target['error'] = str(e)
+            if build_target['state'] == 'cfn_cleanup' or not build_target.has_key('cfn_stack'):
+                if build_target['state'] == 'cfn_cleanup':
+                    self._release_stack_slot()
+                build_target['state'] = 'done'
+            else:
+                build_target['state'] = 'cfn_cleanup'
+            return build_target
+
+    def _build_state_machine(self, build_target, snapshot):
+        from raduga.aws.cfn import AWSCfn, STACK_CREATING_STATES, STACK_CREATED_STATES, STACK_FAILED_STATES
         cfn = AWSCfn(self.targets["aws"])
-        ec2 = AWSEC2(self.targets["aws"])
+        ec2 = self._get_ec2()
         state = build_target['state']
         target = build_target['target']
         target_id = target['target_id']
@@ -140,8 +557,8 @@ class Raduga(object):
         #
         if state == "initial":
             # Check if the target is already being built (previous run)
-            match_cfn_stack = cfn.find_stacks(base_ami=target['base_ami'], target_id=target['target_id'])
-            sleep(2)    # Avoid abusing AWS APIs
+            match_cfn_stack = [ cfn.AWSStack(stack_id) for stack_id in
+                self._get_build_stack_index().lookup(base_ami=target['base_ami'], target_id=target['target_id']) ]
             if len(match_cfn_stack) == 0:
                 # No matching stack, create one
                 build_target['build_stack'] = self._create_build_stack(target)
@@ -150,65 +567,72 @@ class Raduga(object):
             else:
                 # Matching stack, analyze state
                 print "* Found matching CFN stack for target_id %s" % target_id
-                self._running_stacks += 1   # count towards limits
+                self._take_stack_slot()     # count towards limits
                 build_target['cfn_stack'] = match_cfn_stack[0]
                 build_target['state'] = 'cfn_state_check'
                 return build_target
         elif state == 'cfn_launch_ready':
             # Launch the build stack (but avoid having too many running build stacks)
-            if self._running_stacks >= 8:
+            if not self._acquire_stack_slot():
                 return build_target     # Launch later
             build_stack_name = "raduga-build-%s" % target_id
-            cfn_build_stack = cfn.create_stack_in_cfn(
-                stack = build_stack,
-                stack_name = build_stack_name,
-                allow_update = False,
-                tags = dict(
-                    raduga_stack = target['stack_name'],
-                    base_ami = target['base_ami'],
-                    target_id = target_id
+            try:
+                cfn_build_stack = cfn.create_stack_in_cfn(
+                    stack = build_stack,
+                    stack_name = build_stack_name,
+                    allow_update = False,
+                    tags = dict(
+                        raduga_stack = target['stack_name'],
+                        base_ami = target['base_ami'],
+                        target_id = target_id
+                    )
                 )
-            )
-            sleep(2)    # Avoid abusing AWS APIs
+            except:
+                self._release_stack_slot()
+                raise
             #
-            self._running_stacks += 1   # count towards limits
             build_target['state'] = 'cfn_state_check'
             build_target['cfn_stack'] = cfn_build_stack
             print "* Launched CFN stack %s for building target_id %s" % (build_stack_name, target['target_id'])
             return build_target
         elif state == 'cfn_state_check':
-            being_created = cfn_stack.is_being_created()
-            sleep(2)
-            if not being_created:
-                build_target['state'] = 'cfn_creation_check'
-            return build_target
+            stack_status = snapshot.stack_status(cfn_stack.stack_id)
+            # Show progress of the stack, until done
+            if stack_status in STACK_CREATING_STATES and not build_target.has_key('cfn_events'):
+                build_target['cfn_events'] = cfn_stack.tail_events(from_operation_start=True)
+            if build_target.has_key('cfn_events'):
+                self._print_stack_events(target_id, build_target['cfn_events'])
+            if stack_status is None or stack_status in STACK_CREATING_STATES:
+                return build_target
+            build_target['state'] = 'cfn_creation_check'
+            return self._build_state_machine(build_target, snapshot)    # same snapshot answers next check
         elif state == 'cfn_creation_check':
-            is_created = cfn_stack.is_created()
-            sleep(2)
+            is_created = snapshot.stack_status(cfn_stack.stack_id) in STACK_CREATED_STATES
             if is_created:
                 build_target['state'] = 'check_instance_state'
                 build_target['instance_id'] = \
                     cfn_stack.describe_resources()["BuildInstance"]["physical_resource_id"]
             else:
                 build_target['state'] = 'cfn_failure_check'
+                return self._build_state_machine(build_target, snapshot)
             return build_target
         elif state == 'cfn_failure_check':
-            is_failed = cfn_stack.is_failed_or_rollbacked()
-            sleep(2)
+            is_failed = snapshot.stack_status(cfn_stack.stack_id) in STACK_FAILED_STATES
             if is_failed:
                 build_target['result'] = 'FAILED'
                 build_target['state'] = 'cfn_cleanup'
             else:   # stack is probably being deleted, restart the build job
-                self._running_stacks -= 1   # count towards limits
+                self._release_stack_slot()  # count towards limits
+                self._get_build_stack_index().discard(cfn_stack.stack_id)
                 build_target = { "target": target, "state": "initial" }
             return build_target
         elif state == 'check_instance_state':
-            instance_state = ec2.get_instance_state(instance_id)
-            sleep(2)
-            if instance_state == 'running':
+            instance_state = snapshot.instance_state(instance_id)
+            if instance_state is None:
+                pass     # not visible yet
+            elif instance_state == 'running':
                 print "* Stopping instance %s for target %s" % (instance_id, target)
                 ec2.stop_instance(instance_id)
-                sleep(2)
             elif instance_state == 'stopping':
                 pass     # wait until it is indeed stopped
             elif instance_state == 'stopped':
@@ -219,7 +643,6 @@ class Raduga(object):
                     description="Raduga build for stack %s built on %s" % (target['stack_name'], ts),
                     tags=dict(base_ami=target['base_ami'], target_id=target['target_id'], last_phase=target['last_phase'])
                 )
-                sleep(2)
                 print "* Started creation of AMI %s for target %s" % (ami_id, target)
                 build_target['ami_id'] = ami_id
                 build_target['state'] = 'check_ami_state'
@@ -229,8 +652,7 @@ class Raduga(object):
                 build_target['state'] = 'cfn_cleanup'
             return build_target
         elif state == 'check_ami_state':
-            ami_state = ec2.get_ami_state(ami_id)
-            sleep(2)
+            ami_state = snapshot.ami_state(ami_id)
             if ami_state == 'available':
                 build_target['result'] = 'OK'
                 build_target['state'] = 'cfn_cleanup'
@@ -241,14 +663,20 @@ class Raduga(object):
         elif state == 'cfn_cleanup':
             print "* Cleaning up stack with id %s" % cfn_stack.stack_id
             cfn.delete_stack(cfn_stack.stack_id)
-            sleep(2)
-            self._running_stacks -= 1   # count towards limits
+            self._release_stack_slot()  # count towards limits
             build_target['state'] = 'done'
             return build_target
         elif state == 'done':
             return build_target     # do  nothing
 
-    def build_amis(self, stack_sel=None, build_next=False, build_all=False, dry_run=False):
+    def build_amis(self, stack_sel=None, build_next=False, build_all=False, dry_run=False, resume=False):
+        """
+        Builds the AMIs for the buildable launchables in the stacks. Progress
+        is recorded in the build journal; if resume, the last interrupted
+        build continues from the recorded states.
+        """
+        from raduga.journal import BuildJournal
+        from cloudcast.iscm.phased import PURPOSE_BUILD
         if stack_sel is None or len(stack_sel) == 0:
             stacks = self.stacks.keys()
         else:
@@ -256,107 +684,345 @@ class Raduga(object):
         #
         # Process all stacks and collect pending target ids
         build_targets = {}
-        for name in stacks:
-            desc = self.stacks[name]
-            with self._load_stack(name, desc) as stack:
-                buildables = filter(lambda l: l.is_buildable(), stack.get_launchable_resources())
-                for l in buildables:
-                    targets = self._find_ami_for_launchable(l, PURPOSE_BUILD)
-                    # Keep only the first target if not build_all
-                    if len(targets) > 0 and not build_all:
-                        if build_next:
-                            targets = [ targets[-1] ]
-                        else:
-                            targets = targets[0:1]
-                    # Create build states for all targets, skip duplicates
-                    for t in targets:
-                        t['stack_name'] = name
-                        t['last_phase'] = t['run_phases'][-1].phase_name
-                        print str(t)
-                        if build_targets.has_key(t['target_id']):     # skip
-                            print "  ... skipped (target_id already in list build)"
-                        else:
-                            build_targets[t['target_id']] = { "target": t, "state": "initial" }
-        #
-        print "There are %d AMIs to be built" % len(build_targets)
+        with self.distmgr.shared_loading():
+            for name in self._group_by_requirements(stacks):
+                desc = self.stacks[name]
+                with self._load_stack(name, desc) as stack:
+                    buildables = filter(lambda l: l.is_buildable(), stack.get_launchable_resources())
+                    for l in buildables:
+                        targets = self._find_ami_for_launchable(l, PURPOSE_BUILD)
+                        # Keep only the first target if not build_all
+                        if len(targets) > 0 and not build_all:
+                            if build_next:
+                                targets = [ targets[-1] ]
+                            else:
+                                targets = targets[0:1]
+                        # Create build states for all targets, skip duplicates
+                        for t in targets:
+                            t['stack_name'] = name
+                            t['last_phase'] = t['run_phases'][-1].phase_name
+                            print str(t)
+                            if build_targets.has_key(t['target_id']):     # skip
+                                print "  ... skipped (target_id already in list build)"
+                            else:
+                                build_targets[t['target_id']] = { "target": t, "state": "initial" }
         #
-        if len(build_targets) == 0:     # nothing to do
-            return
-        #
-        # Run the build target state machine on each target at a time
         self._running_stacks = 0
-        while True:
-            done_targets = 0
-            for (target_id, target) in build_targets.items():
-                if target['state'] == 'done':
-                    done_targets += 1
+        self._build_stack_index = None
+        region = self.targets["aws"].get_region()
+        journal = BuildJournal(os.path.join(os.getcwd(), ".raduga", "build_journal.sqlite"))
+        try:
+            run_id = None
+            if resume:
+                run_id = journal.last_unfinished_run(region)
+                if run_id is None:
+                    print "* There is no interrupted build to resume"
                 else:
-                    build_targets[target_id] = self._build_state_machine(target)
-            if done_targets == len(build_targets):
-                break   # All done
+                    print "* Resuming build %d" % run_id
+                    self._resume_build_targets(build_targets, journal.latest_states(run_id))
+            #
+            print "There are %d AMIs to be built" % len(build_targets)
+            #
+            if len(build_targets) == 0:     # nothing to do
+                if run_id is not None:
+                    journal.finish_run(run_id)  # not to be resumed again
+                return
+            #
+            if run_id is None:
+                run_id = journal.start_run(region)
+            for bt in build_targets.values():
+                journal.record(run_id, bt)
+            #
+            # Run the build target state machines concurrently, each target is
+            # polled again when it's due
+            scheduler = BuildScheduler(self._build_step,
+                snapshot = self._build_snapshot,
+                workers = self.build_options['workers'],
+                min_poll_interval = self.build_options['min_poll_interval'],
+                max_poll_interval = self.build_options['max_poll_interval'],
+                on_change = lambda target_id, bt: journal.record(run_id, bt))
+            scheduler.run(build_targets)
+            journal.finish_run(run_id)
+        finally:
+            journal.close()
         #
-        from pprint import pprint
-        pprint(build_targets)
+        # Stacks with new AMIs to run have to be deployed again
+        for bt in build_targets.values():
+            if bt.get('result') == 'OK':
+                self._fingerprints.discard(self._fingerprint_key(bt['target']['stack_name']))
+        #
+        for (target_id, bt) in sorted(build_targets.items()):
+            print "* target %s: %s %s" % (target_id, bt.get('result', 'UNKNOWN'),
+                bt.get('ami_id') or bt.get('error') or "")
 
-    def deploy(self, stack_sel=None):
+    def _apply_built_amis(self, stack):
+        """
+        Modifies the buildable launchables in the stack to run the most
+        suitable AMI built for them (if any)
+        """
+        from cloudcast.iscm.phased import PURPOSE_RUN
+        # Find out if there are any buildable launchables in the stack
+        buildables = filter(lambda l: l.is_buildable(), stack.get_launchable_resources())
+        for l in buildables:
+            # Which AMI is best to run for the buildable?
+            target = self._find_ami_for_launchable(l, PURPOSE_RUN)[0]
+            # If there is a built AMI different than the base AMI, modify the element
+            if target['base_ami'] != target['run_ami']:
+                print "Changing Resource %s to use AMI %s and phases to run %s" \
+                    % (l.ref_name, target['run_ami'], target['run_phases'])
+                l.el_attrs["Properties"]["ImageId"] = target['run_ami']
+                l.iscm.set_phases_to_run(target['run_phases'])
+
+    def _stack_dependencies(self, stacks):
+        """
+        Returns dictionary stack -> set of stacks it depends on, as declared
+        with "depends_on" in the stack description
+        """
+        deps = {}
+        for name in stacks:
+            declared = self.stacks[name].get('depends_on', [])
+            for d in declared:
+                if not self.stacks.has_key(d):
+                    raise RuntimeError("Stack %s depends on unknown stack %s" % (name, d))
+            deps[name] = set(declared)
+        return deps
+
+    def _deploy_stack(self, name, stack):
+        """
+        Creates or updates the stack. Returns tuple (CFN stack, whether the
+        stack was left alone because it was up to date)
+        """
+        from raduga.aws.cfn import AWSCfn
         cfn = AWSCfn(self.targets["aws"])
+        cfn_stack = cfn.create_stack_in_cfn(
+            stack = stack,
+            stack_name = self._stack_names[name],
+            allow_update = True,
+            split_nested = self.stacks[name].get('split_nested', False),
+            tag_fingerprint = True )
+        return (cfn_stack, cfn.update_skipped)
+
+    def _fingerprint_key(self, name):
+        # Deployed stacks are told apart by region and CloudFormation name
+        return "%s/%s" % (self.targets["aws"].get_region(), self._stack_names[name])
+
+    def _changed_stacks(self, stacks, inputs):
+        """
+        Returns the stacks whose inputs (dictionary stack -> key of its
+        inputs) changed since they were last deployed from here. Doesn't
+        render stacks. Deployments that weren't waited for
+        are checked in CloudFormation, and only count if they completed. AMIs
+        built since then are only noticed if they were built from here as well.
+        """
+        from raduga.aws.cfn import AWSCfn, STACK_DEPLOYED_STATES
+        unchanged = {}      # stack -> record of the last deployment
+        changed = []
+        for name in stacks:
+            deployed = self._fingerprints.get(self._fingerprint_key(name))
+            if inputs[name] is None or deployed is None or deployed['inputs'] != inputs[name]:
+                changed.append(name)
+            else:
+                unchanged[name] = deployed
+        pending = [ d['stack_id'] for d in unchanged.values() if d.get('stack_id') is not None ]
+        statuses = AWSCfn(self.targets["aws"]).get_stack_statuses(pending) if len(pending) > 0 else {}
+        for name in stacks:
+            if not unchanged.has_key(name):
+                continue
+            deployed = unchanged[name]
+            if deployed.get('stack_id') is not None:
+                if statuses.get(deployed['stack_id']) not in STACK_DEPLOYED_STATES:
+                    print "* stack %s didn't complete its last deployment (%s)" % (name, statuses.get(deployed['stack_id']))
+                    changed.append(name)
+                    continue
+                self._fingerprints.put(self._fingerprint_key(name), deployed['inputs'], deployed['fingerprint'])
+            print "* stack %s is unchanged since last deployed, skipping" % name
+        return changed
+
+    def _record_deployed(self, name, stack, inputs, stack_id=None):
+        """
+        Records the key of the inputs a deployed stack was rendered from. If
+        the deployment wasn't seen to complete, the id of the stack is kept
+        so that it can be checked
+        """
+        if inputs is not None:
+            self._fingerprints.put(self._fingerprint_key(name), inputs, stack.fingerprint(), stack_id)
+
+    def deploy(self, stack_sel=None, changed_only=False, wait=False):
+        """
+        Deploys the stacks, as soon as the stacks they depend on are complete.
+        If wait, also waits for the rest of the stacks to complete, and fails
+        if any of them doesn't.
+        """
+        import time
+        from raduga.aws.cfn import AWSCfn, STACK_DEPLOYED_STATES, STACK_ROLLBACK_STATES
+        #
         if stack_sel is None or len(stack_sel) == 0:
             stacks = self.stacks.keys()
         else:
             stacks = stack_sel
+        # Inputs are taken before rendering, so that changes made while the
+        # stacks are deployed are noticed by the next run
+        inputs = dict((name, self._render_cache_key(name, self.stacks[name])) for name in stacks)
+        if changed_only:
+            stacks = self._changed_stacks(stacks, inputs)
         #
-        for name in stacks:
-            desc = self.stacks[name]
-            with self._load_stack(name, desc) as stack:
-                stack_name = name
-                if desc.has_key('stack_name'):
-                    stack_name = desc['stack_name']
-                # Find out if there are any buildable launchables in the stack
-                buildables = filter(lambda l: l.is_buildable(), stack.get_launchable_resources())
-                for l in buildables:
-                    # Which AMI is best to run for the buildable?
-                    target = self._find_ami_for_launchable(l, PURPOSE_RUN)[0]
-                    # If there is a built AMI different than the base AMI, modify the element
-                    if target['base_ami'] != target['run_ami']:
-                        print "Changing Resource %s to use AMI %s and phases to run %s" \
-                            % (l.ref_name, target['run_ami'], target['run_phases'])
-                        l.el_attrs["Properties"]["ImageId"] = target['run_ami']
-                        l.iscm.set_phases_to_run(target['run_phases'])
-                #
-                cfn_stack = cfn.create_stack_in_cfn(
-                    stack = stack,
-                    stack_name = stack_name,
-                    allow_update = True )
-                print "* deployed/updated CFN stack with name: " + str(cfn_stack)
-
-    def diff(self, stack_sel=None):
+        # Render all the stacks first, so that no stack is deployed if any of
+        # them fails to render
+        graph = DependencyGraph(self._stack_dependencies(stacks))
+        rendered = self._render_stacks(stacks)
+        #
+        # Deploy stacks as soon as the ones they depend on are complete. Unless
+        # wait is set, stacks that no other depends on are not waited for
+        jobs = self.deploy_options['jobs']
+        min_poll_interval = self.deploy_options['min_poll_interval']
+        max_poll_interval = self.deploy_options['max_poll_interval']
+        complete = set()
+        failed = set()
+        launching = {}      # stack -> async result of the deploy call
+        waiting = {}        # stack -> stack id, in progress and being waited for
+        statuses = {}       # stack -> last status seen, of stacks being waited for
+        tailers = {}        # stack -> events tailer, for stacks seen in progress
+        poll_interval = min_poll_interval
+        next_poll = 0
+        blocking = lambda: [ n for n in waiting.keys() if len(graph.dependents(n)) > 0 ]
+        pool = ThreadPool(jobs)
+        try:
+            while len(complete) + len(failed) < len(stacks):
+                # Skip stacks that depend on failed ones, also indirectly
+                skipped = True
+                while skipped:
+                    skipped = False
+                    for name in graph.ready(complete.union(failed)):
+                        if name in launching or name in waiting:
+                            continue
+                        if len(graph.deps[name].intersection(failed)) > 0:
+                            print "[ERROR] not deploying stack %s, stacks it depends on failed" % name
+                            failed.add(name)
+                            skipped = True
+                # Launch stacks ready to go
+                for name in graph.ready(complete.union(failed)):
+                    if name in launching or name in waiting or name in failed:
+                        continue
+                    if len(launching) + len(blocking()) >= jobs:
+                        break
+                    launching[name] = pool.apply_async(self._deploy_stack, (name, rendered[name]))
+                # Collect launched stacks
+                progress = False
+                for (name, result) in launching.items():
+                    if not result.ready():
+                        continue
+                    progress = True
+                    del launching[name]
+                    try:
+                        (cfn_stack, update_skipped) = result.get()
+                    except Exception as e:
+                        print "[ERROR] deploying stack %s: %s" % (name, str(e))
+                        failed.add(name)
+                        continue
+                    print "* deployed/updated CFN stack with name: " + str(cfn_stack)
+                    if update_skipped:
+                        complete.add(name)
+                        self._record_deployed(name, rendered[name], inputs[name])
+                    elif not wait and len(graph.dependents(name)) == 0:
+                        # Not waited for, checked on by the next --changed-only
+                        complete.add(name)
+                        self._record_deployed(name, rendered[name], inputs[name], cfn_stack.stack_id)
+                    else:
+                        waiting[name] = cfn_stack.stack_id
+                        # Start checking soon, as long running stacks are
+                        # checked less often
+                        poll_interval = min_poll_interval
+                        next_poll = min(next_poll, time.time() + poll_interval)
+                # Check on all the stacks being waited for in one go
+                if len(waiting) > 0 and time.time() >= next_poll:
+                    cfn = AWSCfn(self.targets["aws"])
+                    new_statuses = cfn.get_stack_statuses(waiting.values())
+                    changed = False
+                    for (name, stack_id) in waiting.items():
+                        status = new_statuses[stack_id]
+                        changed = changed or status != statuses.get(name)
+                        statuses[name] = status
+                        # Show progress of the stack, until done
+                        if self.deploy_options['show_events']:
+                            if status is not None and status.endswith('_IN_PROGRESS') and not tailers.has_key(name):
+                                tailers[name] = cfn.AWSStack(stack_id).tail_events(from_operation_start=True)
+                            if tailers.has_key(name):
+                                self._print_stack_events(self._stack_names[name], tailers[name])
+                        if status in STACK_DEPLOYED_STATES:
+                            print "* CFN stack %s is complete (%s)" % (self._stack_names[name], status)
+                            complete.add(name)
+                            self._record_deployed(name, rendered[name], inputs[name])
+                        elif status in STACK_ROLLBACK_STATES:
+                            print "[ERROR] CFN stack %s is rolled back (%s)" % (self._stack_names[name], status)
+                            failed.add(name)
+                        elif status is not None and status.endswith('_IN_PROGRESS') and not status.startswith('DELETE_'):
+                            continue
+                        else:
+                            print "[ERROR] CFN stack %s failed (%s)" % (self._stack_names[name], status)
+                            failed.add(name)
+                        progress = True
+                        del waiting[name]
+                        del statuses[name]
+                    if changed:
+                        poll_interval = min_poll_interval
+                    else:
+                        poll_interval = min(poll_interval * 2, max_poll_interval)
+                    next_poll = time.time() + poll_interval
+                if not progress:
+                    if len(launching) > 0 or len(waiting) == 0:
+                        time.sleep(0.1)
+                    else:
+                        time.sleep(max(next_poll - time.time(), 0.1))
+        finally:
+            pool.terminate()
+            pool.join()
+        if len(failed) > 0:
+            raise RuntimeError("Failed to deploy stacks: %s" % ", ".join(sorted(failed)))
+
+    def diff(self, stack_sel=None, jobs=8):
+        from raduga.aws.cfn import AWSCfn
         cfn = AWSCfn(self.targets["aws"])
         if stack_sel is None or len(stack_sel) == 0:
             stacks = self.stacks.keys()
         else:
             stacks = stack_sel
         #
-        for name in stacks:
-            desc = self.stacks[name]
-            with self._load_stack(name, desc) as stack:
-                stack_name = name
-                if desc.has_key('stack_name'):
-                    stack_name = desc['stack_name']
-                # Find out if there are any buildable launchables in the stack
-                buildables = filter(lambda l: l.is_buildable(), stack.get_launchable_resources())
-                for l in buildables:
-                    # Which AMI is best to run for the buildable?
-                    target = self._find_ami_for_launchable(l, PURPOSE_RUN)[0]
-                    # If there is a built AMI different than the base AMI, modify the element
-                    if target['base_ami'] != target['run_ami']:
-                        print "Changing Resource %s to use AMI %s and phases to run %s" \
-                            % (l.ref_name, target['run_ami'], target['run_phases'])
-                        l.el_attrs["Properties"]["ImageId"] = target['run_ami']
-                        l.iscm.set_phases_to_run(target['run_phases'])
-                #
-                cfn.diff_stack_in_cfn(
-                    stack = stack,
-                    stack_name = stack_name )
+        # Fetch the deployed templates in another process while stacks are
+        # rendered here. It is a process, forked before any of the render
+        # workers, so that no process forks while threads are in the middle
+        # of AWS calls (holding locks that would stay locked in the child)
+        from multiprocessing import Process, Pipe
+        (parent_conn, child_conn) = Pipe(duplex=False)
+        fetcher = Process(target=_fetch_templates_worker, args=(self, stacks, jobs, child_conn))
+        fetcher.start()
+        child_conn.close()
+        try:
+            rendered = self._render_stacks(stacks)
+            try:
+                (status, result) = parent_conn.recv()
+            except EOFError:
+                fetcher.join()
+                raise RuntimeError("Process fetching deployed templates died (exit code %s)" % fetcher.exitcode)
+            if status != "ok":
+                raise RuntimeError("Fetching deployed templates failed: %s" % result)
+            # Print the differences in order, as they are found
+            from raduga.aws.tpldiff import format_change
+            for name in stacks:
+                print "STACK: %s" % name
+                cfn_template = result[name]
+                if cfn_template is None:
+                    print "Stack %s is not deployed" % self._stack_names[name]
+                else:
+                    print "Difference cfn -> code"
+                    split_nested = self.stacks[name].get('split_nested', False)
+                    for change in cfn.diff_templates(cfn_template, rendered[name], split_nested):
+                        print format_change(change)
+                print "%s\n\n" % ("-"*79)
+        finally:
+            if fetcher.is_alive():
+                fetcher.terminate()
+            fetcher.join()
+            parent_conn.close()
 
     def printS(self, stack_sel=None):
         if stack_sel is None or len(stack_sel) == 0:
@@ -364,12 +1030,11 @@ class Raduga(object):
         else:
             stacks = stack_sel
         #
+        rendered = self._render_stacks(stacks, apply_amis=False)
         for name in stacks:
-            desc = self.stacks[name]
-            with self._load_stack(name, desc) as stack:
-                print "STACK: %s" % name
-                print stack.dump_json()
-                print "%s\n\n" % ("-"*79)
+            print "STACK: %s" % name
+            print rendered[name].dump_json()
+            print "%s\n\n" % ("-"*79)
 
     def update(self, stack_sel=[]):
         pass
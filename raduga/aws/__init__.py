@@ -1,4 +1,5 @@
 import sys
+from threading import RLock, local
 
 if sys.version_info >= (2,7):
     from collections import OrderedDict
@@ -20,6 +21,7 @@ class Credentials:
     ])
     def __init__(self, **options):
         self.options = options
+        self.name = None    # id in the configuration file, if loaded from it
 
     def __str__(self):
         opts = dict((k,self.options[k]) for k in ('aws_access_key','tags') if k in self.options)
@@ -73,18 +75,67 @@ class Credentials:
         return cls(**ret)
 
 class Target(object):
+    """
+    An AWS account and region to operate on. The target owns the connections
+    to the AWS services, which are long lived and reused. Connections are
+    kept per thread, so that the target can be used from worker threads.
+
+    The name of the bucket for CloudFormation templates is derived from the
+    IAM identity of the credentials. It's only resolved when first needed,
+    and cached in the configuration file for identity_ttl seconds.
+    """
+    identity_ttl = 7 * 24 * 3600
+
     def __init__(self, **kwargs):
         self.region = None
         self.access_key = None
         self.secret_key = None
+        self._creds = None
+        self._cfn_bucket_name = None
+        self._conns = local()
+        self._lock = RLock()
+        self._bucket_checked = False
         if kwargs.has_key("credentials"):
             creds = kwargs["credentials"]
             self.region = creds.options["default_region"]
             self.access_key = creds.options["aws_access_key"]
             self.secret_key = creds.options["aws_secret_key"]
-            self.cfn_bucket_name = self._infer_cfn_bucket_name(creds)
+            self._creds = creds
         if kwargs.has_key("region"):
             self.region = kwargs["region"]
+        if kwargs.has_key("cfn_bucket_name"):
+            self._cfn_bucket_name = kwargs["cfn_bucket_name"]
+
+    @property
+    def cfn_bucket_name(self):
+        with self._lock:
+            if self._cfn_bucket_name is None:
+                self._cfn_bucket_name = self._resolve_cfn_bucket_name()
+            return self._cfn_bucket_name
+
+    def _resolve_cfn_bucket_name(self):
+        if self._creds is None:
+            raise RuntimeError("No credentials to infer the CloudFormation bucket name from")
+        if self._creds.name is None:
+            return self._infer_cfn_bucket_name(self._creds)
+        from raduga.config import config
+        bucket_name = config.get_cached(self._creds.name, "cfn_bucket_name", self.identity_ttl)
+        if bucket_name is None:
+            bucket_name = self._infer_cfn_bucket_name(self._creds)
+            config.set_cached(self._creds.name, "cfn_bucket_name", bucket_name)
+        return bucket_name
+
+    def invalidate_identity(self):
+        """
+        Forgets the resolved bucket name, also from the configuration file
+        cache, so that it's inferred from IAM again on next use
+        """
+        with self._lock:
+            self._cfn_bucket_name = None
+            self._bucket_checked = False
+            if self._creds is not None and self._creds.name is not None:
+                from raduga.config import config
+                config.invalidate_cached(self._creds.name)
 
     def _infer_cfn_bucket_name(self, creds):
         import re
@@ -102,10 +153,58 @@ class Target(object):
         else:
             return lookup
 
+    def get_cfn_bucket(self):
+        """
+        Returns handle to the bucket for CloudFormation templates. The bucket
+        is looked up (and created if needed) only the first time.
+        """
+        with self._lock:
+            if not self._bucket_checked:
+                self.ensure_bucket_exists()
+                self._bucket_checked = True
+        conns = self._get_thread_conns()
+        if not conns.has_key('cfn_bucket'):
+            conns['cfn_bucket'] = self.get_s3_conn().get_bucket(self.cfn_bucket_name, validate=False)
+        return conns['cfn_bucket']
+
     def get_region(self):
         return self.region
 
+    def reset_connections(self):
+        """
+        Drops the connections opened so far. To be used in forked processes,
+        which must not share connections with their parent.
+        """
+        self._conns = local()
+        self._lock = RLock()
+
+    def _get_thread_conns(self):
+        if not hasattr(self._conns, 'conns'):
+            self._conns.conns = {}
+        return self._conns.conns
+
+    def _get_conn(self, service, connect):
+        conns = self._get_thread_conns()
+        if not conns.has_key(service):
+            conns[service] = connect()
+        return conns[service]
+
     def get_ec2_conn(self):
+        return self._get_conn('ec2', lambda: self._throttled(self._connect_ec2(), 'ec2'))
+
+    def get_cfn_conn(self):
+        return self._get_conn('cfn', lambda: self._throttled(self._connect_cfn(), 'cfn'))
+
+    def get_s3_conn(self):
+        return self._get_conn('s3', self._connect_s3)
+
+    def _throttled(self, conn, service):
+        # Calls are rate limited together with all the others to the same
+        # service and region
+        from raduga.aws.throttle import throttled
+        return throttled(conn, service, self.region)
+
+    def _connect_ec2(self):
         import boto.ec2
         return boto.ec2.connect_to_region(
             self.region,
@@ -113,7 +212,7 @@ class Target(object):
             aws_secret_access_key=self.secret_key
         )
 
-    def get_cfn_conn(self):
+    def _connect_cfn(self):
         import boto.cloudformation
         return boto.cloudformation.connect_to_region(
             self.region,
@@ -121,6 +220,6 @@ class Target(object):
             aws_secret_access_key=self.secret_key
         )
 
-    def get_s3_conn(self):
+    def _connect_s3(self):
         from boto.s3.connection import S3Connection
         return S3Connection(self.access_key, self.secret_key)
\ No newline at end of file
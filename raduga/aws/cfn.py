@@ -1,15 +1,50 @@
 from boto.exception import BotoServerError
 from boto.cloudformation.connection import CloudFormationConnection
-from json_tools import diff as json_diff
-import json, logging
+from raduga.aws.tpldiff import diff_templates, format_change
+import json, logging, time
 
 _log = logging.getLogger(__name__)
 _non_delete_states = filter(lambda s: not s.startswith('DELETE_'), CloudFormationConnection.valid_states)
 
+# Classification of stack statuses
+STACK_CREATING_STATES = ['CREATE_IN_PROGRESS', 'UPDATE_IN_PROGRESS']
+STACK_CREATED_STATES = ['CREATE_COMPLETE' , 'UPDATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE']
+STACK_FAILED_STATES = ['CREATE_FAILED', 'ROLLBACK_IN_PROGRESS', 'ROLLBACK_FAILED', 'ROLLBACK_COMPLETE']
+
+# Outcome of a create or update operation, by stack status. Other statuses
+# ending in _IN_PROGRESS mean the operation is still going on, the rest are
+# failures.
+STACK_DEPLOYED_STATES = ['CREATE_COMPLETE', 'UPDATE_COMPLETE', 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS']
+STACK_ROLLBACK_STATES = ['ROLLBACK_IN_PROGRESS', 'ROLLBACK_COMPLETE', 'UPDATE_ROLLBACK_IN_PROGRESS',
+    'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS', 'UPDATE_ROLLBACK_COMPLETE']
+
+# Tag of the stacks, with the fingerprint of the template deployed
+FINGERPRINT_TAG = 'raduga_fingerprint'
+
 class AWSCfn(object):
-    def __init__(self, target):
-        self.bucket = target.ensure_bucket_exists()
-        self.conn = target.get_cfn_conn()
+    # Seconds a stack description is reused before asking CloudFormation again
+    describe_ttl = 5
+    # When splitting into nested stacks is enabled, templates bigger than
+    # nested_split_size are split into children with resources adding up
+    # to at most nested_child_size
+    nested_split_size = 250 * 1024
+    nested_child_size = 100 * 1024
+
+    def __init__(self, target, describe_ttl=None):
+        self.target = target
+        if describe_ttl is not None:
+            self.describe_ttl = describe_ttl
+        self._stacks = {}
+        self._tag_indexes = {}
+        self.update_skipped = False
+
+    @property
+    def conn(self):
+        return self.target.get_cfn_conn()
+
+    @property
+    def bucket(self):
+        return self.target.get_cfn_bucket()
 
     def create_stack_in_cfn(self, **kwargs):
         """
@@ -19,6 +54,11 @@ class AWSCfn(object):
         Additional args:
             parameters = list of tuples with parameter values
             allow_update = whether to allow update operations
+            split_nested = whether to split big templates into nested stacks
+            tag_fingerprint = whether to tag the stack with the fingerprint of
+                              its template
+        After the call, update_skipped tells whether the stack was left alone
+        because it was already up to date.
         """
         if not kwargs.has_key('parameters') or kwargs['parameters'] is None:
             parameters=[]
@@ -31,26 +71,48 @@ class AWSCfn(object):
 
         stack = kwargs['stack']
         stack_name = kwargs['stack_name']
+        self.update_skipped = False
+        templates = self._get_template_bodies(stack, kwargs.get('split_nested', False))
+        tags = kwargs.get('tags')
+        if kwargs.get('tag_fingerprint', False):
+            # Nested stack templates are covered too, their urls are in the
+            # template of the stack
+            tags = dict(tags or {})
+            tags[FINGERPRINT_TAG] = self._template_hash(templates[-1])
         
         # Create the stack
         try:
-            if not self.stack_exists(stack_name):
+            updating = self.stack_exists(stack_name)
+            if not updating:
                 cfn_api_call = self.conn.create_stack
             elif not kwargs['allow_update']:
                 raise RuntimeError("Stack already exists but updates not allowed!")
             else:
                 cfn_api_call = self.conn.update_stack
+                if self._is_stack_unchanged(templates[-1], stack_name, parameters, tags):
+                    print "* CFN stack %s is up to date, not updating" % stack_name
+                    self.update_skipped = True
+                    return self.AWSStack(self.AWSStack(stack_name).describe()['stack_id'])
 
-            template_url = self._upload_stack_template(stack, stack_name)
+            for template_body in templates:
+                template_url = self._upload_template_body(template_body)
             api_call_args = dict(
                 stack_name=kwargs['stack_name'],
                 template_url=template_url,
                 parameters=parameters,
                 capabilities=stack.required_capabilities
             )
-            if kwargs.has_key('tags'):
-                api_call_args['tags'] = kwargs['tags']
-            stack_id = cfn_api_call(**api_call_args)
+            if tags is not None:
+                api_call_args['tags'] = tags
+            try:
+                stack_id = cfn_api_call(**api_call_args)
+            except BotoServerError as e:
+                if not updating or not _is_no_updates_error(e):
+                    raise
+                print "* CFN stack %s is up to date, not updating" % stack_name
+                self.update_skipped = True
+                return self.AWSStack(self.AWSStack(stack_name).describe()['stack_id'])
+            self.AWSStack(stack_name).refresh()     # status is changing
             return self.AWSStack(stack_id)
         except BotoServerError as e:
             raise RuntimeError("AWS returned: " + str(e.args))
@@ -76,31 +138,101 @@ class AWSCfn(object):
         stack = kwargs['stack']
         stack_name = kwargs['stack_name']
 
-        if not self.stack_exists(stack_name):
+        cfn_template = self.get_deployed_template(stack_name)
+        if cfn_template is None:
             raise RuntimeError("Stack %s is not deployed" % stack_name)
+        # TODO: compare parameters as well
+        print "Difference cfn -> code"
+        for change in self.diff_templates(cfn_template, stack):
+            print format_change(change)
 
+    def get_deployed_template(self, stack_name):
+        """
+        Returns the template of a deployed stack, parsed. None if the stack
+        is not deployed
+        """
+        if not self.stack_exists(stack_name):
+            return None
         try:
-            cfn_stack = self.get_created_stack(stack_name).get_template()
-            cfn_stack = json.loads(cfn_stack['GetTemplateResponse']['GetTemplateResult']['TemplateBody'])
-            stack_template = json.loads(stack.dump_json(pretty=False))
-            diff = json_diff(cfn_stack, stack_template)
-            # TODO: compare parameters as well
-            print "Difference cfn -> code"
-            print json.dumps(diff, indent=2)
+            cfn_template = self.get_created_stack(stack_name).get_template()
+            return json.loads(cfn_template['GetTemplateResponse']['GetTemplateResult']['TemplateBody'])
         except BotoServerError as e:
             raise RuntimeError("AWS returned: " + str(e.args))
 
-    def _upload_stack_template(self, stack, stack_name):
-        import random, time
-        from boto.s3.key import Key
-        k = Key(self.bucket)
-        k.key = "raduga-%s-%d-%s" % ( stack_name, int(time.time()), "%04x" % random.randrange(16**4))
+    def diff_templates(self, cfn_template, stack, split_nested=False):
+        """
+        Generates the differences between a deployed template and the given
+        stack code, one per changed resource or section entry (see
+        raduga.aws.tpldiff). Doesn't call AWS. If split_nested, the stack is
+        split as it would be deployed and compared as the parent stack; the
+        nested stacks show up as changed when their templates (and so their
+        template urls) changed.
+        """
+        stack_template = json.loads(self._get_template_bodies(stack, split_nested)[-1])
+        return diff_templates(cfn_template, stack_template)
+
+    def _get_template_bodies(self, stack, split_nested):
+        """
+        Returns the list of template bodies to upload for the stack. The
+        template of the stack itself goes last, after the templates of its
+        nested stacks (if it was split)
+        """
         template_body = stack.dump_json(pretty=False)
-        #print "Uploading\n%s\n\n" % template_body
-        #
-        _log.info("Uploading stack template to S3 (size %dKB out of 300KB allowed)" % (len(template_body) / 1024))
-        k.set_contents_from_string(template_body)
-        return "https://s3.amazonaws.com/%s/%s" % (self.bucket.name, k.key)
+        if not split_nested or len(template_body) <= self.nested_split_size:
+            return [ template_body ]
+        from raduga.aws.nested import split_template, set_child_template_urls
+        (parent, children) = split_template(json.loads(template_body), self.nested_child_size)
+        _log.info("Splitting stack template (size %dKB) into %d nested stacks" % (len(template_body) / 1024, len(children)))
+        bodies = dict((child, json.dumps(tpl, separators=(',',':'), sort_keys=True)) for (child, tpl) in children.items())
+        set_child_template_urls(parent, dict((child, self._template_url(body)) for (child, body) in bodies.items()))
+        return [ bodies[child] for child in sorted(bodies.keys()) ] + \
+            [ json.dumps(parent, separators=(',',':'), sort_keys=True) ]
+
+    def _is_stack_unchanged(self, template_body, stack_name, parameters, tags):
+        """
+        Tells whether the deployed stack already has the template, parameters
+        and tags that an update would set. If the tags include the template
+        fingerprint, the template itself is not fetched for comparison.
+        """
+        st = self.AWSStack(stack_name)
+        # Only the parameters passed are compared: the rest take their
+        # defaults, which are part of the template. NoEcho values can't be
+        # compared, as they are masked.
+        deployed_params = dict((k, p['value']) for (k, p) in st.describe_parameters().items())
+        for (k, v) in dict(parameters).items():
+            if deployed_params.get(k) != v or deployed_params.get(k) == _NO_ECHO_VALUE:
+                return False
+        if tags is not None and dict(st.get_tags()) != tags:
+            return False
+        if tags is not None and tags.has_key(FINGERPRINT_TAG):
+            return True
+        return self.get_deployed_template(stack_name) == json.loads(template_body)
+
+    def _template_hash(self, template_body):
+        import hashlib
+        return hashlib.sha256(template_body).hexdigest()
+
+    def _template_key(self, template_body):
+        return "raduga-tpl-%s.json" % self._template_hash(template_body)
+
+    def _template_url(self, template_body):
+        return "https://s3.amazonaws.com/%s/%s" % (self.target.cfn_bucket_name, self._template_key(template_body))
+
+    def _upload_template_body(self, template_body):
+        """
+        Uploads template to S3, under a key derived from its contents, so that
+        templates already there are not uploaded again
+        """
+        from boto.s3.key import Key
+        key_name = self._template_key(template_body)
+        if self.bucket.get_key(key_name) is None:
+            _log.info("Uploading stack template to S3 (size %dKB out of 300KB allowed)" % (len(template_body) / 1024))
+            k = Key(self.bucket)
+            k.key = key_name
+            k.set_contents_from_string(template_body)
+        else:
+            _log.info("Stack template already in S3 as %s" % key_name)
+        return self._template_url(template_body)
 
     def stack_exists(self, stack_name):
         st = self.AWSStack(stack_name)
@@ -120,26 +252,148 @@ class AWSCfn(object):
         ss = self.conn.list_stacks(_non_delete_states)
         return [ s.stack_name for s in ss ]
 
+    def iter_stacks(self):
+        """
+        Streams the descriptions of all the stacks in the account, requesting
+        them page by page
+        """
+        next_token = None
+        while True:
+            ss = self.conn.describe_stacks(next_token=next_token)
+            for s in ss:
+                yield s
+            next_token = ss.next_token
+            if next_token is None:
+                break
+
+    def get_stack_statuses(self, stack_ids):
+        """
+        Returns a dictionary stack_id -> stack_status for all the given stacks.
+        Statuses are resolved from a single (paginated) describe_stacks listing,
+        only stacks missing from it (i.e. already deleted) are looked up one
+        by one. Stacks that can't be found have a None status.
+        """
+        wanted = set(stack_ids)
+        ret = {}
+        if len(wanted) == 0:
+            return ret
+        for s in self.iter_stacks():
+            if s.stack_id in wanted:
+                ret[s.stack_id] = s.stack_status
+            elif s.stack_name in wanted:
+                ret[s.stack_name] = s.stack_status
+        for stack_id in wanted.difference(ret.keys()):
+            try:
+                ret[stack_id] = self.conn.describe_stacks(stack_name_or_id=stack_id)[0].stack_status
+            except BotoServerError as e:
+                if e.code != 'ValidationError':
+                    raise
+                ret[stack_id] = None
+        return ret
+
     def find_stacks(self, **tags):
-        stacks = self.conn.describe_stacks()
-        matches = filter(lambda s: all( map(lambda t: t in s.tags.items(), tags.items() ) ), stacks )
-        return [ self.AWSStack(s.stack_id) for s in matches ]
+        """
+        Returns the stacks having all the given tag values. If an index
+        over exactly those tag keys was built (see index_stacks), it is used
+        instead of listing the stacks
+        """
+        tag_keys = tuple(sorted(tags.keys()))
+        if self._tag_indexes.has_key(tag_keys):
+            stack_ids = self._tag_indexes[tag_keys].lookup(**tags)
+        else:
+            stack_ids = [ s.stack_id for s in self.iter_stacks()
+                          if all(s.tags.get(k) == v for (k,v) in tags.items()) ]
+        return [ self.AWSStack(stack_id) for stack_id in stack_ids ]
+
+    def index_stacks(self, *tag_keys):
+        """
+        Builds an index of the stacks in the account by the values of the
+        given tag keys, with a single listing. Further find_stacks calls
+        by those tags are answered from the index.
+        """
+        index = StackTagIndex(self.iter_stacks(), tag_keys)
+        self._tag_indexes[index.tag_keys] = index
+        return index
     
     def delete_stack(self, stack_name, **kwargs):
         self.conn.delete_stack(stack_name)
-        return self.AWSStack(stack_name)
+        st = self.AWSStack(stack_name)
+        st.refresh()
+        return st
 
     def AWSStack(self, stack_id):
-        return _AWSStack(self, stack_id)
+        """
+        Returns the stack object for the given id or name. Objects are kept,
+        so that their description snapshot is shared by all the users
+        """
+        if not self._stacks.has_key(stack_id):
+            self._stacks[stack_id] = _AWSStack(self, stack_id)
+        return self._stacks[stack_id]
+
+class StackTagIndex(object):
+    """
+    Index of stack ids by the values of a set of tags, i.e. (base_ami, target_id)
+    """
+    def __init__(self, stacks, tag_keys):
+        self.tag_keys = tuple(sorted(tag_keys))
+        self._index = {}
+        for s in stacks:
+            if all(s.tags.has_key(k) for k in self.tag_keys):
+                key = tuple(s.tags[k] for k in self.tag_keys)
+                self._index.setdefault(key, []).append(s.stack_id)
+
+    def _key(self, tags):
+        if sorted(tags.keys()) != list(self.tag_keys):
+            raise RuntimeError("Index is on tags %s, not %s" % (str(self.tag_keys), str(tags.keys())))
+        return tuple(tags[k] for k in self.tag_keys)
+
+    def lookup(self, **tags):
+        return list(self._index.get(self._key(tags), []))
+
+    def discard(self, stack_id):
+        for stack_ids in self._index.values():
+            if stack_id in stack_ids:
+                stack_ids.remove(stack_id)
 
 class _AWSStack:
-    def __init__(self, cfn, stack_id):
+    def __init__(self, cfn, stack_id, ttl=None):
         self.cfn = cfn
         self.stack_id = stack_id
+        self.ttl = ttl
+        self._snapshot = None
+        self._snapshot_time = None
+
+    def refresh(self):
+        """
+        Discards the stack description snapshot, the next query will get
+        fresh information from CloudFormation
+        """
+        self._snapshot = None
+        self._snapshot_time = None
+
+    def _get_snapshot(self):
+        ttl = self.cfn.describe_ttl if self.ttl is None else self.ttl
+        if self._snapshot is None or time.time() - self._snapshot_time > ttl:
+            cfn = self.cfn.conn
+            s = cfn.describe_stacks(stack_name_or_id=self.stack_id)[0]
+            outputs = [vars(o) for o in s.outputs]
+            params = [vars(p) for p in s.parameters]
+            desc = vars(s)
+            desc['parameters'] = params
+            desc['outputs'] = outputs
+            desc['tags'] = s.tags
+            self._snapshot = dict(
+                desc = desc,
+                parameters = dict([(p['key'],p) for p in params]),
+                outputs = dict([(o['key'],o) for o in outputs])
+            )
+            self._snapshot_time = time.time()
+        return self._snapshot
 
     def describe(self):
         """
-        Returns dictionary describing the stack status. Relevant entries:
+        Returns dictionary describing the stack status. The description is
+        a snapshot, reused for some seconds (see refresh()). Relevant entries:
             "stack_status" -- stack creation status
             "parameters" -- list of dictionaries describing provided
                             parameters. Each dictionary's relevant keys:
@@ -151,15 +405,7 @@ class _AWSStack:
                 "value" -- output value
                 "description" -- description of the output
         """
-        cfn = self.cfn.conn
-        s = cfn.describe_stacks(stack_name_or_id=self.stack_id)[0]
-        outputs = [vars(o) for o in s.outputs]
-        params = [vars(p) for p in s.parameters]
-        ret = vars(s)
-        ret['parameters'] = params
-        ret['outputs'] = outputs
-        ret['tags'] = s.tags 
-        return ret
+        return self._get_snapshot()['desc']
         
     def describe_resources(self):
         """
@@ -188,15 +434,23 @@ class _AWSStack:
             "resource_status_reason" -- explanation of status change (useful for errors)
         Events are returned ordered by timestamp. The not_these parameter
         serves the purpose for passing a list of events that shouldn't be
-        included in the returned list (filtering is done based on event_id)
+        included in the returned list (filtering is done based on event_id).
+        This goes through the whole history of the stack, use tail_events()
+        for following new events.
         """
-        cfn = self.cfn.conn
         blocked_events = set(e['event_id'] for e in not_these)
-        s = cfn.describe_stacks(stack_name_or_id=self.stack_id)[0]
-        events = filter(lambda e: e['event_id'] not in blocked_events,
-            [vars(e) for e in s.describe_events()])
-        events.sort(key=lambda e: e['timestamp'])
+        events = [ vars(e) for page in _event_pages(self.cfn, self.stack_id)
+                   for e in page if e.event_id not in blocked_events ]
+        events.reverse()
         return events
+
+    def tail_events(self, from_operation_start=False):
+        """
+        Returns StackEventTailer following the events of the stack, from
+        now on or, if from_operation_start, from the start of the create,
+        update or delete operation in course (or last one)
+        """
+        return StackEventTailer(self.cfn, self.stack_id, from_operation_start)
         
     def describe_parameters(self):
         """
@@ -205,12 +459,10 @@ class _AWSStack:
             "key" -- parameter name
             "value" -- parameter value at stack creation
         """
-        st = self.describe()
-        return dict([(p['key'],p) for p in st['parameters']])
+        return self._get_snapshot()['parameters']
         
     def describe_outputs(self):
-        st = self.describe()
-        return dict([(p['key'],p) for p in st['outputs']])
+        return self._get_snapshot()['outputs']
     
     def get_stack_status(self):
         status = self.describe()
@@ -226,7 +478,7 @@ class _AWSStack:
     
     def is_being_created(self):
         status = self.describe()
-        return status['stack_status'] in ['CREATE_IN_PROGRESS', 'UPDATE_IN_PROGRESS']
+        return status['stack_status'] in STACK_CREATING_STATES
         
     def is_being_deleted(self):
         status = self.describe()
@@ -234,7 +486,7 @@ class _AWSStack:
         
     def is_created(self):
         status = self.describe()
-        return status['stack_status'] in ['CREATE_COMPLETE' , 'UPDATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE' ]
+        return status['stack_status'] in STACK_CREATED_STATES
 
     def is_deleted(self):
         status = self.describe()
@@ -242,7 +494,7 @@ class _AWSStack:
 
     def is_failed_or_rollbacked(self):
         status = self.describe()
-        return (status['stack_status'] in ['CREATE_FAILED', 'ROLLBACK_IN_PROGRESS', 'ROLLBACK_FAILED', 'ROLLBACK_COMPLETE'])
+        return (status['stack_status'] in STACK_FAILED_STATES)
 
     def is_rollback_triggered(self):
         status = self.describe()
@@ -251,3 +503,65 @@ class _AWSStack:
     def is_delete_triggered(self):
         status = self.describe()
         return (status['stack_status'] in ['DELETE_IN_PROGRESS', 'DELETE_FAILED', 'DELETE_COMPLETE'])
+
+# How CloudFormation shows the values of NoEcho parameters
+_NO_ECHO_VALUE = '****'
+
+def _is_no_updates_error(e):
+    # Error returned when updating a stack with nothing to change
+    return e.error_code == 'ValidationError' and 'No updates are to be performed' in str(e.error_message)
+
+def _event_pages(cfn, stack_id):
+    """
+    Pages of events of a stack, newest events first. The connection is
+    looked up for every page, as it belongs to the calling thread.
+    """
+    next_token = None
+    while True:
+        page = cfn.conn.describe_stack_events(stack_name_or_id=stack_id, next_token=next_token)
+        yield page
+        next_token = page.next_token
+        if next_token is None:
+            break
+
+def _is_operation_start(e):
+    # Event of the stack itself starting an operation
+    return e.physical_resource_id == e.stack_id and \
+        e.resource_status in ('CREATE_IN_PROGRESS', 'UPDATE_IN_PROGRESS', 'DELETE_IN_PROGRESS')
+
+class StackEventTailer(object):
+    """
+    Follows the events of a stack. Each poll pages through the events of
+    the stack newest first, only until the last event seen, so that polls
+    cost the same however long the history of the stack is. It may be
+    polled from any thread.
+    """
+    def __init__(self, cfn, stack_id, from_operation_start=False):
+        self.cfn = cfn
+        self.stack_id = stack_id
+        self.last_event_id = None
+        if not from_operation_start:
+            for page in _event_pages(cfn, stack_id):
+                if len(page) > 0:
+                    self.last_event_id = page[0].event_id
+                break
+
+    def poll(self):
+        """
+        Returns the events (dictionaries, as in describe_events) since the
+        last poll, oldest first
+        """
+        new_events = [ vars(e) for e in self._new_events() ]
+        if len(new_events) > 0:
+            self.last_event_id = new_events[0]['event_id']
+        new_events.reverse()
+        return new_events
+
+    def _new_events(self):
+        for page in _event_pages(self.cfn, self.stack_id):
+            for e in page:
+                if e.event_id == self.last_event_id:
+                    return
+                yield e
+                if self.last_event_id is None and _is_operation_start(e):
+                    return
@@ -1,13 +1,67 @@
-from time import sleep
+from threading import Lock
+from boto.exception import BotoServerError
+
+class AMIIndex(object):
+    """
+    Index of the AMIs built by raduga, by the values of their base_ami and
+    target_id tags. The last_phase tag of each AMI is kept as well.
+    """
+    def __init__(self, images=[]):
+        self._index = {}
+        self._lock = Lock()
+        for image in images:
+            self.add(image.id, image.tags)
+
+    def add(self, image_id, tags):
+        if not tags.has_key('base_ami') or not tags.has_key('target_id'):
+            return      # not a raduga build
+        key = (tags['base_ami'], tags['target_id'])
+        with self._lock:
+            entries = self._index.setdefault(key, [])
+            if image_id not in [ e['image_id'] for e in entries ]:
+                entries.append(dict(image_id=image_id, last_phase=tags.get('last_phase')))
+
+    def get(self, base_ami, target_id):
+        """
+        Returns dictionary with "image_id" and "last_phase" of the AMI matching
+        the given tags, None if there isn't any
+        """
+        entries = self._index.get((base_ami, target_id), [])
+        if len(entries) == 0:
+            return None
+        elif len(entries) == 1:
+            return entries[0]
+        else:
+            raise RuntimeError("More than ona AMI is matching the requested tags (??!)")
 
 class AWSEC2(object):
-    def __init__(self, target):
-        self.conn = target.get_ec2_conn()
+    def __init__(self, target, ami_index=None):
+        self.target = target
+        self.ami_index = ami_index
+
+    @property
+    def conn(self):
+        return self.target.get_ec2_conn()
 
     def get_instance_state(self, instance_id):
         instance = self.conn.get_only_instances(instance_id)[0]
         return instance.state
 
+    def get_instance_states(self, instance_ids):
+        """
+        Returns a dictionary instance_id -> state for all the given instances,
+        using a single API call. Instances that are not visible yet are left out.
+        """
+        if len(instance_ids) == 0:
+            return {}
+        try:
+            instances = self.conn.get_only_instances(instance_ids=list(instance_ids))
+        except BotoServerError as e:
+            if not str(e.code).startswith('InvalidInstanceID'):
+                raise
+            instances = self.conn.get_only_instances(filters={ 'instance-id': list(instance_ids) })
+        return dict((i.id, i.state) for i in instances)
+
     def stop_instance(self, instance_id):
         self.conn.stop_instances(instance_id)
 
@@ -16,16 +70,47 @@ class AWSEC2(object):
         if instance.state != 'stopped':
             raise RuntimeError("Won't create AMI from non-stopped instance")
         image_id = self.conn.create_image(instance_id, name, description)
-        sleep(1)
-        # Add tags to the image
-        self.conn.create_tags(image_id, tags)
+        # Add tags to the image, as soon as it's visible
+        from raduga.aws.throttle import retry_call
+        retry_call(self.conn.create_tags, (image_id, tags),
+            retryable=lambda e: str(e.code) == 'InvalidAMIID.NotFound')
+        if self.ami_index is not None:
+            self.ami_index.add(image_id, tags)
         return image_id
 
     def get_ami_state(self, image_id):
         ami = self.conn.get_all_images(image_id)[0]
         return ami.state
 
+    def get_ami_states(self, image_ids):
+        """
+        Returns a dictionary image_id -> state for all the given images, using
+        a single API call. Images that are not visible yet are left out.
+        """
+        if len(image_ids) == 0:
+            return {}
+        try:
+            amis = self.conn.get_all_images(image_ids=list(image_ids))
+        except BotoServerError as e:
+            if not str(e.code).startswith('InvalidAMIID'):
+                raise
+            # Some image is not registered yet, filter by id instead, which
+            # doesn't fail for missing ones
+            amis = self.conn.get_all_images(filters={ 'image-id': list(image_ids) })
+        return dict((ami.id, ami.state) for ami in amis)
+
+    def index_amis(self):
+        """
+        Builds an index of our own AMIs with a single listing. Further
+        find_ami calls by base_ami and target_id are answered from the index.
+        """
+        self.ami_index = AMIIndex(self.conn.get_all_images(owners=['self']))
+        return self.ami_index
+
     def find_ami(self, **tags):
+        if self.ami_index is not None and sorted(tags.keys()) == ['base_ami', 'target_id']:
+            match = self.ami_index.get(**tags)
+            return match is not None and match['image_id'] or None
         filters = dict(map(lambda (k,v): ("tag:"+k,v), tags.items()))
         results = self.conn.get_all_images(owners=['self'], filters=filters)
         if len(results) == 0:
@@ -0,0 +1,323 @@
+"""
+Splitting of big templates into nested stacks. The resources of a template
+are partitioned into child stacks; references between resources that end
+up in different children are rewired through child stack outputs and
+parameters, so that CloudFormation can create independent children in
+parallel.
+"""
+
+import json
+
+_PSEUDO_PREFIX = "AWS::"
+
+# CloudFormation limits on the number of entries in a template
+MAX_RESOURCES = 200
+MAX_PARAMETERS = 60
+MAX_OUTPUTS = 60
+
+def _walk_refs(el, on_ref, on_getatt):
+    """
+    Calls on_ref(name) for every {"Ref": name} and on_getatt(name, attr)
+    for every {"Fn::GetAtt": [name, attr]} found in the element
+    """
+    if isinstance(el, dict):
+        if el.keys() == ["Ref"] and isinstance(el["Ref"], basestring):
+            on_ref(el["Ref"])
+            return
+        if el.keys() == ["Fn::GetAtt"] and isinstance(el["Fn::GetAtt"], list):
+            on_getatt(el["Fn::GetAtt"][0], el["Fn::GetAtt"][1])
+            return
+        for v in el.values():
+            _walk_refs(v, on_ref, on_getatt)
+    elif isinstance(el, list):
+        for v in el:
+            _walk_refs(v, on_ref, on_getatt)
+
+def _rewrite_refs(el, rewrite_ref, rewrite_getatt):
+    """
+    Returns copy of the element where references are replaced by the
+    return values of rewrite_ref(name) and rewrite_getatt(name, attr)
+    """
+    if isinstance(el, dict):
+        if el.keys() == ["Ref"] and isinstance(el["Ref"], basestring):
+            return rewrite_ref(el["Ref"])
+        if el.keys() == ["Fn::GetAtt"] and isinstance(el["Fn::GetAtt"], list):
+            return rewrite_getatt(el["Fn::GetAtt"][0], el["Fn::GetAtt"][1])
+        return dict((k, _rewrite_refs(v, rewrite_ref, rewrite_getatt)) for (k, v) in el.items())
+    elif isinstance(el, list):
+        return [ _rewrite_refs(v, rewrite_ref, rewrite_getatt) for v in el ]
+    return el
+
+def _find_conditions(el, found):
+    """ Collects names of conditions used by the element """
+    if isinstance(el, dict):
+        for (k, v) in el.items():
+            if k in ("Condition", "Fn::If"):
+                found.add(isinstance(v, list) and v[0] or v)
+            _find_conditions(v, found)
+    elif isinstance(el, list):
+        for v in el:
+            _find_conditions(v, found)
+    return found
+
+def _depends_on(res):
+    deps = res.get("DependsOn", [])
+    if isinstance(deps, list):
+        return deps
+    return [ deps ]
+
+def _resource_deps(resources, name):
+    """ Names of the resources the given resource refers to """
+    deps = set()
+    _walk_refs(resources[name], lambda n: deps.add(n), lambda n, a: deps.add(n))
+    deps.update(_depends_on(resources[name]))
+    return deps.intersection(resources.keys())
+
+def _topological_order(resources):
+    order = []
+    done = set()
+    deps = dict((name, _resource_deps(resources, name)) for name in resources.keys())
+    while len(done) < len(resources):
+        ready = sorted(n for n in resources.keys() if n not in done and deps[n].issubset(done))
+        if len(ready) == 0:
+            raise RuntimeError("Circular references between resources %s" % ", ".join(sorted(set(resources.keys()) - done)))
+        order.extend(ready)
+        done.update(ready)
+    return order
+
+def _used_conditions(el, conditions):
+    """ Names of conditions used by the element, also through other conditions """
+    used = _find_conditions(el, set())
+    while True:
+        more = _find_conditions(dict((c, conditions[c]) for c in used if conditions.has_key(c)), set(used))
+        if more == used:
+            return used
+        used = more
+
+def _resource_inputs(template, name):
+    """
+    Values a resource takes from outside its child stack, unless the
+    resources they come from are in the same child: set of ("param", name)
+    for template parameters (also through conditions) and ("res", name,
+    attr) for Refs (attr None) and GetAtts of other resources
+    """
+    resources = template.get("Resources", {})
+    parameters = template.get("Parameters", {})
+    conditions = template.get("Conditions", {})
+    inputs = set()
+    def on_ref(n):
+        if parameters.has_key(n):
+            inputs.add(("param", n))
+        elif resources.has_key(n) and n != name:
+            inputs.add(("res", n, None))
+    def on_getatt(n, attr):
+        if resources.has_key(n) and n != name:
+            inputs.add(("res", n, attr))
+    _walk_refs(resources[name], on_ref, on_getatt)
+    used = _used_conditions(resources[name], conditions)
+    _walk_refs(dict((c, conditions[c]) for c in used if conditions.has_key(c)), on_ref, lambda n, a: None)
+    return inputs
+
+def _size(el):
+    return len(json.dumps(el, separators=(',', ':')))
+
+def _output_name(name, attr=None):
+    """ Name of child output exporting a Ref or a GetAtt of a resource """
+    import re
+    if attr is None:
+        return "Ref" + name
+    return "Att" + name + re.sub(r'[^A-Za-z0-9]', "", attr)
+
+def partition_resources(template, max_child_size):
+    """
+    Returns list of lists of resource names. Resources are taken in
+    dependency order and packed into groups of at most max_child_size
+    bytes, MAX_RESOURCES resources and MAX_PARAMETERS parameters, so that
+    groups only depend on earlier groups. Raises RuntimeError if a group
+    would have to export more than MAX_OUTPUTS values to later ones.
+    """
+    resources = template.get("Resources", {})
+    groups = []
+    group_of = {}       # resource -> index of its group
+    exports = {}        # group index -> values exported to later groups
+    current = []
+    current_size = 0
+    current_inputs = set()
+    for name in _topological_order(resources):
+        size = _size(resources[name])
+        inputs = _resource_inputs(template, name)
+        new_inputs = current_inputs.union(i for i in inputs if i[0] == "param" or i[1] not in current)
+        if len(current) > 0 and (current_size + size > max_child_size or len(current) >= MAX_RESOURCES or
+                                 len(new_inputs) > MAX_PARAMETERS):
+            groups.append(current)
+            current = []
+            current_size = 0
+            new_inputs = set(inputs)
+        if len(new_inputs) > MAX_PARAMETERS:
+            raise RuntimeError("Resource %s takes more than %d values from outside its nested stack" % (name, MAX_PARAMETERS))
+        for i in inputs:
+            if i[0] == "res" and group_of[i[1]] < len(groups):
+                exported = exports.setdefault(group_of[i[1]], set())
+                exported.add(i[1:])
+                if len(exported) > MAX_OUTPUTS:
+                    raise RuntimeError("Resources in the nested stack of %s are used by more than %d values elsewhere" % (i[1], MAX_OUTPUTS))
+        current.append(name)
+        group_of[name] = len(groups)
+        current_size += size
+        current_inputs = new_inputs
+    if len(current) > 0:
+        groups.append(current)
+    return groups
+
+def split_template(template, max_child_size, child_name="Nested%02d"):
+    """
+    Splits a template into a parent template and child templates. Returns
+    a tuple (parent, children) where children is a dictionary of logical
+    name of the child stack in the parent -> child template. The parent
+    refers to child templates by the "TemplateURL" placeholder
+    {"Raduga::ChildTemplate": logical name}, which has to be replaced with
+    the url the child template is uploaded to (see set_child_template_urls).
+    """
+    resources = template.get("Resources", {})
+    parameters = template.get("Parameters", {})
+    conditions = template.get("Conditions", {})
+    mappings = template.get("Mappings", {})
+    groups = partition_resources(template, max_child_size)
+    group_of = {}
+    for (i, group) in enumerate(groups):
+        for name in group:
+            group_of[name] = child_name % i
+    children = {}
+    child_params = dict((child_name % i, {}) for i in range(len(groups)))
+    child_outputs = dict((child_name % i, {}) for i in range(len(groups)))
+    child_deps = dict((child_name % i, set()) for i in range(len(groups)))
+    optional_params = set()     # parameters for values of conditional resources
+
+    def export(name, attr=None):
+        """ Exports a Ref or GetAtt of a resource from its child, returns
+            the expression to use it from the parent """
+        child = group_of[name]
+        out = _output_name(name, attr)
+        if attr is None:
+            child_outputs[child][out] = { "Value": { "Ref": name } }
+        else:
+            child_outputs[child][out] = { "Value": { "Fn::GetAtt": [ name, attr ] } }
+        value = { "Fn::GetAtt": [ child, "Outputs." + out ] }
+        # Outputs of conditional resources only exist under their condition
+        condition = resources[name].get("Condition")
+        if condition is not None:
+            child_outputs[child][out]["Condition"] = condition
+            optional_params.add(out)
+            value = { "Fn::If": [ condition, value, { "Ref": "AWS::NoValue" } ] }
+        return value
+
+    for (i, group) in enumerate(groups):
+        child = child_name % i
+        params = child_params[child]
+        def rewrite_ref(name):
+            if name.startswith(_PSEUDO_PREFIX) or group_of.get(name) == child:
+                return { "Ref": name }
+            if parameters.has_key(name):
+                params[name] = { "Ref": name }
+                return { "Ref": name }
+            if group_of.has_key(name):
+                out = _output_name(name)
+                params[out] = export(name)
+                child_deps[child].add(group_of[name])
+                return { "Ref": out }
+            return { "Ref": name }
+        def rewrite_getatt(name, attr):
+            if not group_of.has_key(name) or group_of[name] == child:
+                return { "Fn::GetAtt": [ name, attr ] }
+            out = _output_name(name, attr)
+            params[out] = export(name, attr)
+            child_deps[child].add(group_of[name])
+            return { "Ref": out }
+        child_resources = {}
+        for name in group:
+            res = _rewrite_refs(resources[name], rewrite_ref, rewrite_getatt)
+            # Dependencies on resources of other children become dependencies
+            # between the children
+            deps = [ d for d in _depends_on(res) if group_of.get(d) == child ]
+            for d in _depends_on(res):
+                if group_of.has_key(d) and group_of[d] != child:
+                    child_deps[child].add(group_of[d])
+            if res.has_key("DependsOn"):
+                if len(deps) > 0:
+                    res["DependsOn"] = deps
+                else:
+                    del res["DependsOn"]
+            child_resources[name] = res
+        # Conditions used in the child (also through other conditions), and
+        # the parameters they refer to
+        used_conditions = _used_conditions(child_resources, conditions)
+        child_conditions = dict((c, conditions[c]) for c in used_conditions if conditions.has_key(c))
+        def add_param(name):
+            if parameters.has_key(name):
+                params[name] = { "Ref": name }
+        _walk_refs(child_conditions, add_param, lambda n, a: None)
+        children[child] = dict(
+            AWSTemplateFormatVersion = template.get("AWSTemplateFormatVersion", "2010-09-09"),
+            Resources = child_resources
+        )
+        if len(child_conditions) > 0:
+            children[child]["Conditions"] = child_conditions
+        if len(mappings) > 0 and "Fn::FindInMap" in json.dumps(child_resources):
+            children[child]["Mappings"] = mappings
+
+    # Parameters and outputs of the children
+    for (child, params) in child_params.items():
+        child_tpl_params = {}
+        for p in params.keys():
+            if parameters.has_key(p):
+                child_tpl_params[p] = dict(parameters[p])
+                child_tpl_params[p].pop("Default", None)    # always passed by the parent
+                p_type = parameters[p].get("Type", "")
+                if p_type == "CommaDelimitedList" or p_type.startswith("List<"):
+                    params[p] = { "Fn::Join": [ ",", { "Ref": p } ] }
+            elif p in optional_params:
+                # Not passed when the condition of the resource is false
+                child_tpl_params[p] = { "Type": "String", "Default": "" }
+            else:
+                child_tpl_params[p] = { "Type": "String" }
+        if len(child_tpl_params) > 0:
+            children[child]["Parameters"] = child_tpl_params
+
+    # The parent template
+    parent = dict((k, v) for (k, v) in template.items() if k not in ("Resources", "Outputs"))
+    parent["Resources"] = {}
+    for (child, params) in child_params.items():
+        child_res = {
+            "Type": "AWS::CloudFormation::Stack",
+            "Properties": { "TemplateURL": { "Raduga::ChildTemplate": child } }
+        }
+        if len(params) > 0:
+            child_res["Properties"]["Parameters"] = params
+        if len(child_deps[child]) > 0:
+            child_res["DependsOn"] = sorted(child_deps[child])
+        parent["Resources"][child] = child_res
+    if template.has_key("Outputs"):
+        parent["Outputs"] = _rewrite_refs(template["Outputs"],
+            lambda n: group_of.has_key(n) and export(n) or { "Ref": n },
+            lambda n, a: group_of.has_key(n) and export(n, a) or { "Fn::GetAtt": [ n, a ] })
+    # Outputs of the children, used by other children or by the parent
+    for (child, outputs) in child_outputs.items():
+        if len(outputs) > 0:
+            children[child]["Outputs"] = outputs
+    for (child, tpl) in children.items():
+        for (section, limit) in (("Resources", MAX_RESOURCES), ("Parameters", MAX_PARAMETERS), ("Outputs", MAX_OUTPUTS)):
+            if len(tpl.get(section, {})) > limit:
+                raise RuntimeError("Nested stack %s would have %d %s, more than the %d allowed" %
+                    (child, len(tpl[section]), section.lower(), limit))
+    return (parent, children)
+
+def set_child_template_urls(parent, urls):
+    """
+    Replaces the child template placeholders in the parent template with
+    the given urls (dictionary of child logical name -> url)
+    """
+    for (child, res) in parent["Resources"].items():
+        tpl_url = res.get("Properties", {}).get("TemplateURL")
+        if isinstance(tpl_url, dict) and tpl_url.has_key("Raduga::ChildTemplate"):
+            res["Properties"]["TemplateURL"] = urls[tpl_url["Raduga::ChildTemplate"]]
+    return parent
@@ -0,0 +1,32 @@
+"""
+Batched status polling. A snapshot resolves the status of many stacks,
+instances and images at once, so that code driving many resources at the
+same time pays one API round trip per kind of resource and poll cycle.
+"""
+
+from raduga.aws.cfn import AWSCfn
+from raduga.aws.ec2 import AWSEC2
+
+class StatusSnapshot(object):
+    def __init__(self, target, stack_ids=[], instance_ids=[], image_ids=[]):
+        self.stacks = {}
+        self.instances = {}
+        self.images = {}
+        if len(stack_ids) > 0:
+            self.stacks = AWSCfn(target).get_stack_statuses(set(stack_ids))
+        if len(instance_ids) > 0 or len(image_ids) > 0:
+            ec2 = AWSEC2(target)
+            self.instances = ec2.get_instance_states(set(instance_ids))
+            self.images = ec2.get_ami_states(set(image_ids))
+
+    def stack_status(self, stack_id):
+        """ Stack status, None if unknown """
+        return self.stacks.get(stack_id)
+
+    def instance_state(self, instance_id):
+        """ Instance state, None if unknown """
+        return self.instances.get(instance_id)
+
+    def ami_state(self, image_id):
+        """ Image state, None if unknown """
+        return self.images.get(image_id)
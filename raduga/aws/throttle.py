@@ -0,0 +1,100 @@
+"""
+Rate limiting of AWS API calls. Calls to a service in a region go through
+a token bucket shared by all the connections to them, so that concurrent
+workers together stay within the request rate of the account. Calls
+rejected for throttling anyway are retried, with jittered exponential
+backoff.
+"""
+
+import logging, random, time
+from threading import Lock
+from boto.exception import BotoServerError
+
+_log = logging.getLogger(__name__)
+
+# Error codes of requests rejected for going over the request rate
+THROTTLING_CODES = set([ 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                         'RequestThrottled', 'SlowDown' ])
+
+# Requests per second and burst size allowed to each service, per region
+rates = {
+    'ec2': (20, 40),
+    'cfn': (5, 10)
+}
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._last = time.time()
+        self._lock = Lock()
+
+    def acquire(self):
+        """ Takes a token, waiting for one if there are none left """
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+_buckets = {}
+_buckets_lock = Lock()
+
+def get_bucket(service, region):
+    """ Returns the token bucket shared by the calls to service in region """
+    with _buckets_lock:
+        if not _buckets.has_key((service, region)):
+            (rate, burst) = rates[service]
+            _buckets[(service, region)] = TokenBucket(rate, burst)
+        return _buckets[(service, region)]
+
+def is_throttling(e):
+    return str(e.code) in THROTTLING_CODES
+
+def retry_call(f, args=(), kwargs={}, retryable=is_throttling, retries=8, base_delay=0.5, max_delay=20):
+    """
+    Calls f, retrying it while it fails with a BotoServerError that is
+    retryable. Delays between attempts are random, up to an exponentially
+    growing maximum, so that clients retrying at once spread out.
+    """
+    attempt = 0
+    while True:
+        try:
+            return f(*args, **kwargs)
+        except BotoServerError as e:
+            if attempt >= retries or not retryable(e):
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            _log.info("AWS call %s failed with %s, retrying in %.1fs" % (getattr(f, '__name__', f), e.code, delay))
+            time.sleep(delay)
+            attempt += 1
+
+class ThrottledConnection(object):
+    """
+    Wraps a boto connection, so that its API calls take a token from the
+    bucket before each attempt and are retried when throttled
+    """
+    def __init__(self, conn, bucket):
+        self._conn = conn
+        self._bucket = bucket
+
+    def __getattr__(self, name):
+        attr = getattr(self._conn, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        def throttled_call(*args, **kwargs):
+            def attempt():
+                self._bucket.acquire()
+                return attr(*args, **kwargs)
+            attempt.__name__ = name
+            return retry_call(attempt)
+        return throttled_call
+
+def throttled(conn, service, region):
+    return ThrottledConnection(conn, get_bucket(service, region))
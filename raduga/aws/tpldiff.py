@@ -0,0 +1,94 @@
+"""
+Differences between CloudFormation templates. Sections of the templates
+keyed by logical name (resources, parameters, outputs...) are compared
+entry by entry, by hash, and only the entries whose hashes differ are
+walked to find the paths that changed. Changes are produced as they are
+found, one per entry.
+"""
+
+import json, hashlib
+
+# Sections compared entry by entry
+KEYED_SECTIONS = [ "Parameters", "Mappings", "Conditions", "Resources", "Outputs" ]
+
+# Stands for a value missing on one side of a change (None is JSON null)
+MISSING = object()
+
+def _hash(el):
+    return hashlib.sha1(json.dumps(el, sort_keys=True, separators=(',',':'))).hexdigest()
+
+def diff_templates(old, new):
+    """
+    Generates the differences between two templates (parsed). Each one is a
+    dictionary with entries:
+        "change" -- "added", "removed" or "modified"
+        "path" -- list of keys to the entry, i.e. [ "Resources", "WebServer" ]
+        "old", "new" -- value of the entry in each template (if present)
+        "changes" -- for modified entries, list of tuples (path, old, new)
+                     for each difference within the entry (path relative to
+                     the entry, MISSING for a missing old or new value)
+    """
+    for section in sorted(set(old.keys()).union(new.keys())):
+        if not new.has_key(section):
+            yield dict(change="removed", path=[ section ], old=old[section])
+        elif not old.has_key(section):
+            yield dict(change="added", path=[ section ], new=new[section])
+        elif section in KEYED_SECTIONS and isinstance(old[section], dict) and isinstance(new[section], dict):
+            if _hash(old[section]) == _hash(new[section]):
+                continue
+            for change in _diff_entries(section, old[section], new[section]):
+                yield change
+        elif old[section] != new[section]:
+            yield _modified([ section ], old[section], new[section])
+
+def _diff_entries(section, old, new):
+    old_hashes = dict((name, _hash(el)) for (name, el) in old.items())
+    new_hashes = dict((name, _hash(el)) for (name, el) in new.items())
+    for name in sorted(set(old.keys()).union(new.keys())):
+        if not new.has_key(name):
+            yield dict(change="removed", path=[ section, name ], old=old[name])
+        elif not old.has_key(name):
+            yield dict(change="added", path=[ section, name ], new=new[name])
+        elif old_hashes[name] != new_hashes[name]:
+            yield _modified([ section, name ], old[name], new[name])
+
+def _modified(path, old, new):
+    return dict(change="modified", path=path, old=old, new=new, changes=list(_diff_values([], old, new)))
+
+def _diff_values(path, old, new):
+    """ Generates (path, old, new) for the differing leaves of two values """
+    if isinstance(old, dict) and isinstance(new, dict):
+        for k in sorted(set(old.keys()).union(new.keys())):
+            if not new.has_key(k):
+                yield (path + [ k ], old[k], MISSING)
+            elif not old.has_key(k):
+                yield (path + [ k ], MISSING, new[k])
+            elif old[k] != new[k]:
+                for d in _diff_values(path + [ k ], old[k], new[k]):
+                    yield d
+    elif isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        for (i, (o, n)) in enumerate(zip(old, new)):
+            if o != n:
+                for d in _diff_values(path + [ i ], o, n):
+                    yield d
+    elif old != new:
+        yield (path, old, new)
+
+def _format_path(path):
+    return "".join(isinstance(p, int) and "[%d]" % p or (i > 0 and "." or "") + p for (i, p) in enumerate(path))
+
+def _format_value(v, max_len=80):
+    if v is MISSING:
+        return "(missing)"
+    s = json.dumps(v, sort_keys=True)
+    if len(s) > max_len:
+        s = s[:max_len - 3] + "..."
+    return s
+
+def format_change(change):
+    """ Returns printable description of a change, in one or more lines """
+    mark = { "added": "+", "removed": "-", "modified": "~" }[change["change"]]
+    lines = [ "%s %s" % (mark, _format_path(change["path"])) ]
+    for (path, old, new) in change.get("changes", []):
+        lines.append("    %s: %s -> %s" % (_format_path(path) or "(value)", _format_value(old), _format_value(new)))
+    return "\n".join(lines)
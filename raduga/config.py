@@ -2,8 +2,9 @@
 """
 Management of configuration files and their contents
 """
-import os, stat, sys
+import os, stat, sys, time, json
 from ConfigParser import SafeConfigParser
+from threading import Lock
 
 from raduga.aws import Credentials
     
@@ -36,15 +37,25 @@ def _load_conf_file():
 def _save_conf_file(cfg):
     """
     Given a ConfigParser object, it saves its contents to the config
-    file location, overwriting any previous contents
+    file location, overwriting any previous contents. The contents are
+    written to a temporary file that is then renamed into place, so that
+    other processes reading the file never see it truncated.
     """
+    import tempfile
     conf_path = _locate_conf_file()
-    f = open(conf_path, "w")
-    cfg.write(f)
-    f.close()
-    # Make sure it has restricted permissons (since it tends to have stuff
-    # like credentials in it)
-    os.chmod(conf_path, stat.S_IRUSR + stat.S_IWUSR)
+    (fd, tmp_path) = tempfile.mkstemp(prefix=".raduga.cfg.", dir=os.path.dirname(conf_path))
+    try:
+        # Make sure it has restricted permissons (since it tends to have stuff
+        # like credentials in it)
+        os.chmod(tmp_path, stat.S_IRUSR + stat.S_IWUSR)
+        f = os.fdopen(fd, "w")
+        cfg.write(f)
+        f.close()
+        os.rename(tmp_path, conf_path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
 def _load_ini_file():
     """
@@ -67,57 +78,157 @@ def _save_ini_file(ini):
     ini.write(f)
     f.close()
 
+def _conf_file_stamp():
+    """ Modification time and size of the conf file, None if it doesn't exist """
+    try:
+        st = os.stat(_locate_conf_file())
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+def _encode_value(v):
+    # Dictionaries are stored as JSON
+    if type(v) == str:
+        return v
+    elif type(v) == dict:
+        return json.dumps(v, sort_keys=True)
+    raise RuntimeError("Unhandled conf value type: %s" % str(type(v)))
+
+def _decode_value(v):
+    if v.startswith("{"):
+        return json.loads(v)
+    elif v.startswith("dict(") and v.endswith(")"):
+        # Older files have dictionaries as "dict(<python literal>)"
+        import ast
+        return ast.literal_eval(v[len("dict("):-1])
+    return v
+
 class Config:
+    """
+    Contents of the configuration file. The file is parsed once, and again
+    only if it changes. Credentials are decoded once and indexed by tag.
+    """
     def __init__(self):
+        self._load()
+
+    def _load(self):
+        self._stamp = _conf_file_stamp()
         self.conf = _load_conf_file()
+        self._credentials = None    # credentials name -> Credentials
+        self._tag_index = None      # (tag, value) -> set of credentials names
+
+    def _check_reload(self):
+        if _conf_file_stamp() != self._stamp:
+            self._load()
 
     def _save(self):
         _save_conf_file(self.conf)
+        self._stamp = _conf_file_stamp()
+        self._credentials = None
+        self._tag_index = None
+
+    def _get_credentials_index(self):
+        """
+        Returns tuple (credentials by name, credentials names by tag)
+        """
+        self._check_reload()
+        if self._credentials is None:
+            credentials = {}
+            tag_index = {}
+            for s in self.conf.sections():
+                if not s.startswith("cr-") or not self.conf.has_option(s, "_class") or \
+                        self.conf.get(s, "_class") != "credentials":
+                    continue
+                name = s[len("cr-"):]
+                creds = self._decode_credentials(self.conf.items(s), name)
+                credentials[name] = creds
+                for tag in (creds.options.get("tags") or {}).items():
+                    tag_index.setdefault(tag, set()).add(name)
+            (self._credentials, self._tag_index) = (credentials, tag_index)
+        return (self._credentials, self._tag_index)
 
     def add_credentials(self, name, creds):
+        self._check_reload()
         section_name = "cr-" + name
         self.conf.add_section(section_name)
         self.conf.set(section_name, "_class", "credentials")
         for (k,v) in creds.options.iteritems():
-            if type(v) == str:
-                self.conf.set(section_name, k, v)
-            elif type(v) == dict:
-                self.conf.set(section_name, k, "dict(%s)" % str(v))
-            else:
-                raise RuntimeError("Unhandled conf value type: %s" % str(type(v)))
+            self.conf.set(section_name, k, _encode_value(v))
         self._save()
 
     def get_credentials(self, name):
-        section_name = "cr-" + name
-        return self._decode_credentials(self.conf.items(section_name))
+        (credentials, _) = self._get_credentials_index()
+        if not credentials.has_key(name):
+            raise RuntimeError("No credentials with id %s" % name)
+        return credentials[name]
 
-    def _decode_credentials(self, items):
-        return Credentials.from_dict_items(
-            map(lambda(k,v): (k,v.startswith("dict(") and eval(v) or v), items)
+    def _decode_credentials(self, items, name=None):
+        items = filter(lambda(k,v): not k.startswith("_cached_"), items)
+        creds = Credentials.from_dict_items(
+            map(lambda(k,v): (k,_decode_value(v)), items)
         )
+        creds.name = name
+        return creds
+
+    def get_cached(self, name, key, ttl):
+        """
+        Returns value cached along the credentials with the given name, if it
+        was stored less than ttl seconds ago. Otherwise returns None
+        """
+        self._check_reload()
+        section_name = "cr-" + name
+        opt = "_cached_" + key
+        if not self.conf.has_option(section_name, opt) or not self.conf.has_option(section_name, opt + "_time"):
+            return None
+        if time.time() - self.conf.getfloat(section_name, opt + "_time") > ttl:
+            return None
+        return self.conf.get(section_name, opt)
+
+    def set_cached(self, name, key, value):
+        self._check_reload()
+        section_name = "cr-" + name
+        opt = "_cached_" + key
+        self.conf.set(section_name, opt, value)
+        self.conf.set(section_name, opt + "_time", "%d" % time.time())
+        self._save()
+
+    def invalidate_cached(self, name, key=None):
+        """
+        Removes the given cached key (or all of them) for the credentials with
+        the given name
+        """
+        self._check_reload()
+        section_name = "cr-" + name
+        for (opt, _) in self.conf.items(section_name):
+            if (key is None and opt.startswith("_cached_")) or opt in ("_cached_" + str(key), "_cached_%s_time" % key):
+                self.conf.remove_option(section_name, opt)
+        self._save()
 
     def find_credentials(self, **tags):
-        ret = []
-        def creds_match(creds):
-            # Compare configure cred tags against given filter
-            for (tk,tv) in tags.items():
-                if not creds_tags.has_key(tk):
-                    return False
-                if creds_tags[tk] != tv:
-                    return False
-            return True
-        for s in self.conf.sections():
-            if self.conf.get(s, "_class") != "credentials":
-                continue
-            creds = self._decode_credentials(self.conf.items(s))
-            creds_tags = creds.options.has_key("tags") and creds.options["tags"] or {}
-            if creds_match(creds):
-                ret.append(creds)
-        if len(ret) > 1:
-            raise RuntimeException("More than one set of credentials match the provided tags " + str(tags))
-        if len(ret) == 0:
+        (credentials, tag_index) = self._get_credentials_index()
+        names = set(credentials.keys())
+        for tag in tags.items():
+            names.intersection_update(tag_index.get(tag, ()))
+        if len(names) > 1:
+            raise RuntimeError("More than one set of credentials match the provided tags " + str(tags))
+        if len(names) == 0:
             return None
-        return ret[0]
+        return credentials[names.pop()]
+
+class _LazyConfig(object):
+    """
+    Stands for the Config object, loading the configuration file only when
+    it's first used
+    """
+    def __init__(self):
+        self._config = None
+        self._lock = Lock()
+
+    def __getattr__(self, name):
+        with self._lock:
+            if self._config is None:
+                self._config = Config()
+        return getattr(self._config, name)
 
 # Export the configuration via "config"
-config = Config()
+config = _LazyConfig()
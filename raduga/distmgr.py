@@ -3,31 +3,110 @@ Handle distributions. These utilities allow several versions of the same
 distributed package to be installed in our "raduga_modules" folder. Stacks
 can specify which version they need, and that version be loaded in isolation
 while that stack is being processed.
+
+The distribution chosen for each set of requirements is recorded (by name
+and version) in the "raduga.lock" file, so that later runs keep using it
+while it's installed. Installing a distribution releases the locks on its
+project, so that the next run picks the best match again.
+
+Installed distributions are listed in a manifest, so that the modules folder
+is only scanned again when it changes.
+
+Distributions are kept as zipped eggs, which are imported from directly,
+unless they are flagged as not zip safe; those are extracted into folders.
 """
 
-import os, os.path
+import os, os.path, json, hashlib, logging
 from contextlib import contextmanager
+from threading import Lock
 from pkg_resources import Environment, Distribution, Requirement, working_set
 
+_log = logging.getLogger(__name__)
+
 class DistributionsManager(object):
-	def __init__(self):
+	def __init__(self, zipped=True):
+		self.zipped = zipped		# keep installed eggs zipped when possible
 		self.mod_folder = os.path.join(os.getcwd(), "raduga_modules")
+		self.lock_file = os.path.join(os.getcwd(), "raduga.lock")
+		self.manifest_file = os.path.join(os.getcwd(), ".raduga", "modules_manifest.json")
 		if not os.path.exists(self.mod_folder):
 			os.mkdir(self.mod_folder)
 		self._init_environment()
+		self._resolved = {}		# requirements key -> distributions
+		self._locks = None		# contents of the lock file
+		self._active = None		# (requirements key, sys.path, sys.modules) of active requirements
+		self._sharing = 0
+		self._users = 0
+		self._install_lock = Lock()
 
 	def _init_environment(self):
-		dist_folders = map(lambda d: os.path.join(os.getcwd(), self.mod_folder, d), os.listdir(self.mod_folder))
-		dist_folders = filter(lambda f: os.path.exists(os.path.join(f, "EGG-INFO")), dist_folders)
-		dists = map(lambda f: Distribution.from_filename(f) , dist_folders)
+		manifest = self._load_manifest()
+		if manifest is None or manifest['mtime'] != os.stat(self.mod_folder).st_mtime:
+			manifest = self._scan_modules(manifest)
+		self.manifest = manifest
 		#
 		self.pkg_env = Environment()
-		for dist in dists: self.pkg_env.add(dist)
+		for entry in manifest['dists']:
+			self._add_to_environment(os.path.join(self.mod_folder, entry['path']))
 
 	def _add_to_environment(self, egg_folder):
 		dist = Distribution.from_filename(egg_folder)
 		self.pkg_env.add(dist)
 
+	def _load_manifest(self):
+		if not os.path.exists(self.manifest_file):
+			return None
+		try:
+			with open(self.manifest_file) as f:
+				return json.load(f)
+		except ValueError:
+			return None
+
+	def _save_manifest(self, manifest):
+		# Record the modification time of the folder, as of this manifest
+		manifest['mtime'] = os.stat(self.mod_folder).st_mtime
+		if not os.path.exists(os.path.dirname(self.manifest_file)):
+			os.makedirs(os.path.dirname(self.manifest_file))
+		with open(self.manifest_file, "w") as f:
+			json.dump(manifest, f, indent=2, sort_keys=True)
+
+	def _scan_modules(self, old_manifest):
+		"""
+		Builds the manifest of installed distributions from the contents of
+		the modules folder. Content hashes are only computed for distributions
+		that were not in the old manifest
+		"""
+		old_entries = {}
+		if old_manifest is not None:
+			old_entries = dict((e['path'], e) for e in old_manifest['dists'])
+		entries = []
+		for d in sorted(os.listdir(self.mod_folder)):
+			if d.startswith(".") or not _is_egg(os.path.join(self.mod_folder, d)):
+				continue
+			if old_entries.has_key(d):
+				entries.append(old_entries[d])
+			else:
+				entries.append(self._manifest_entry(d, _hash_path(os.path.join(self.mod_folder, d))))
+		manifest = dict(dists=entries)
+		self._save_manifest(manifest)
+		return manifest
+
+	def _manifest_entry(self, path, content_hash, source_hash=None):
+		dist = Distribution.from_filename(path)
+		return dict(name=dist.project_name, version=dist.version, path=path,
+			content_hash=content_hash, source_hash=source_hash)
+
+	def _register_dist(self, path, content_hash, source_hash=None):
+		"""
+		Adds an installed distribution to the manifest and the environment
+		"""
+		replaced = [ e for e in self.manifest['dists'] if e['path'] == path ]
+		self.manifest['dists'] = [ e for e in self.manifest['dists'] if e['path'] != path ]
+		self.manifest['dists'].append(self._manifest_entry(path, content_hash, source_hash))
+		self._save_manifest(self.manifest)
+		if len(replaced) == 0:
+			self._add_to_environment(os.path.join(self.mod_folder, path))
+
 	def _match_req(self, req):
 		return self.pkg_env.best_match(req, working_set)
 
@@ -40,50 +119,261 @@ class DistributionsManager(object):
 				reqs[req.key] = req
 		return reqs.values()
 
-	@contextmanager
-	def requirement_loader(self, *req_sets):
-		# Save sys.path and sys.modules, to be restored later
-		import sys, copy
-		old_path = copy.copy(sys.path)
-		old_sys_modules = sys.modules.keys()
-		# Find distributions for all the requirements
-		req_dists = []
+	def _reqs_key(self, reqs):
+		return ",".join(sorted(str(req) for req in reqs))
+
+	def _load_locks(self):
+		if self._locks is None:
+			self._locks = {}
+			if os.path.exists(self.lock_file):
+				with open(self.lock_file) as f:
+					self._locks = json.load(f)
+		return self._locks
+
+	def _save_locks(self):
+		with open(self.lock_file, "w") as f:
+			json.dump(self._locks, f, indent=2, sort_keys=True)
+
+	def _lock_entry(self, dist):
+		# Distributions are recorded by name and version, not by location,
+		# so that the lock file holds in any checkout of the project
+		return "%s==%s" % (dist.project_name, dist.version)
+
+	def _release_locks(self, project_key):
+		"""
+		Removes the project from the locked resolutions, so that they are
+		resolved again (i.e. after installing a new version of it)
+		"""
+		locks = self._load_locks()
+		changed = False
+		for (key, locked) in locks.items():
+			if locked.pop(project_key, None) is not None:
+				changed = True
+		if changed:
+			self._save_locks()
+
+	def _locked_dist(self, req, locked):
+		# The locked distribution, if still installed and matching
+		for dist in self.pkg_env[req.key]:
+			if self._lock_entry(dist) == locked.get(req.key) and dist in req:
+				return dist
+		return None
+
+	def resolve_requirements(self, *req_sets):
+		"""
+		Returns the distributions matching the requirements, without
+		activating them. Resolutions are done once per run, and recorded
+		in the lock file.
+		"""
 		reqs = self._flatten_reqs(req_sets)
+		key = self._reqs_key(reqs)
+		if self._resolved.has_key(key):
+			return self._resolved[key]
+		locks = self._load_locks()
+		locked = locks.get(key, {})
+		req_dists = []
 		for req in reqs:
-			match = self._match_req(req)
+			match = self._locked_dist(req, locked)
+			best = self._match_req(req)
+			if match is None:
+				match = best
+			elif best is not None and best.parsed_version > match.parsed_version:
+				_log.warning("Using %s as locked in raduga.lock, although %s is installed" %
+					(self._lock_entry(match), self._lock_entry(best)))
 			if match is None:
 				raise RuntimeError("Unable to find distribution matching %s" % str(req))
 			req_dists.append(match)
-		# Activate the distributions, return control
-		for req in req_dists: req.activate()
-		yield
+		new_locked = dict((dist.key, self._lock_entry(dist)) for dist in req_dists)
+		if len(req_dists) > 0 and new_locked != locked:
+			locks[key] = new_locked
+			self._save_locks()
+		self._resolved[key] = req_dists
+		return req_dists
+
+	@contextmanager
+	def requirement_loader(self, *req_sets):
+		"""
+		Activates the distributions for the requirements, and deactivates them
+		on exit. Within shared_loading(), they are kept active on exit, and
+		reused by the next user with the same requirements.
+		"""
+		key = self._reqs_key(self._flatten_reqs(req_sets))
+		if self._active is None or self._active[0] != key:
+			if self._users > 0:
+				raise RuntimeError("Other requirements are being used")
+			self._deactivate()
+			self._activate(key, self.resolve_requirements(*req_sets))
+		self._users += 1
+		try:
+			yield
+		finally:
+			self._users -= 1
+			if self._users == 0 and self._sharing == 0:
+				self._deactivate()
+
+	@contextmanager
+	def shared_loading(self):
+		"""
+		Within this context, consecutive users of the same requirements share
+		a single activation, so that modules are imported only once for them
+		"""
+		self._sharing += 1
+		try:
+			yield
+		finally:
+			self._sharing -= 1
+			if self._users == 0 and self._sharing == 0:
+				self._deactivate()
+
+	def _activate(self, key, req_dists):
+		# Save sys.path and sys.modules, to be restored later
+		import sys, copy
+		self._active = (key, copy.copy(sys.path), set(sys.modules.keys()))
+		for dist in req_dists: dist.activate()
+
+	def _deactivate(self):
 		# Restore sys path and modules
+		import sys
+		if self._active is None:
+			return
+		(_, old_path, old_sys_modules) = self._active
+		self._active = None
 		sys.path = old_path
 		for modname in sys.modules.keys():
 			if not modname in old_sys_modules:
 				del sys.modules[modname]
 
 	def install_dist(self, path):
+		"""
+		Builds and installs the distribution in the given source folder. The
+		build is skipped if a distribution built from exactly the same sources
+		is already installed. Returns the path of the installed egg.
+		"""
 		setup_py = os.path.join(os.getcwd(), path, "setup.py")
 		if not os.path.isfile(setup_py):
 			raise RuntimeError("Folder %s doesn't have a setup file" % path)
+		source_hash = _hash_sources(os.path.dirname(setup_py))
+		installed = self._find_installed(source_hash)
+		if installed is not None:
+			print "* %s is already installed as %s" % (path, installed)
+			return installed
 		with self._build_egg_env(path) as tempdir:
-			import subprocess, zipfile
-			subprocess.check_call(["python", setup_py, "bdist_egg", "--dist-dir=%s" % tempdir])
+			import subprocess, sys
+			subprocess.check_call([sys.executable, setup_py, "bdist_egg", "--dist-dir=%s" % tempdir],
+				cwd=os.path.dirname(setup_py))
 			egg = os.listdir(tempdir)[0]    # egg will be the single entry in the temp folder
-			# TODO: check if exactly that same egg is installed
-			eggf = os.path.join(self.mod_folder, egg)   # target egg folder
-			os.mkdir(eggf)
-			eggz = zipfile.ZipFile(os.path.join(tempdir, egg))
-			eggz.extractall(eggf)
+			with self._install_lock:
+				self._place_egg(os.path.join(tempdir, egg), egg)
+				self._register_dist(egg, _hash_file(os.path.join(tempdir, egg)), source_hash)
+				self._release_locks(Distribution.from_filename(egg).key)
+			return egg
+
+	def install_dists(self, paths, jobs=4):
+		"""
+		Installs the distributions in the given source folders, building
+		several of them at the same time
+		"""
+		from multiprocessing.pool import ThreadPool
+		pool = ThreadPool(jobs)
+		try:
+			return pool.map(self.install_dist, paths)
+		finally:
+			pool.terminate()
+			pool.join()
+
+	def _find_installed(self, source_hash):
+		for entry in self.manifest['dists']:
+			if entry.get('source_hash') == source_hash and \
+					os.path.exists(os.path.join(self.mod_folder, entry['path'])):
+				return entry['path']
+		return None
+
+	def _place_egg(self, egg_file, egg):
+		"""
+		Copies the egg (or extracts it, if it isn't zip safe) into the modules
+		folder, replacing any previous egg with the same name
+		"""
+		import zipfile, shutil, tempfile
+		eggf = os.path.join(self.mod_folder, egg)   # target egg file or folder
+		eggz = zipfile.ZipFile(egg_file)
+		# Prepare next to the target, then move into place
+		tmpf = tempfile.mkdtemp(prefix=".%s-" % egg, dir=self.mod_folder)
+		try:
+			if self.zipped and _is_zip_safe(eggz):
+				tmp_egg = os.path.join(tmpf, egg)
+				shutil.copyfile(egg_file, tmp_egg)
+			else:
+				tmp_egg = tmpf
+				eggz.extractall(tmpf)
+				os.chmod(tmpf, 0755)
+			if os.path.isdir(eggf):
+				shutil.rmtree(eggf)
+			os.rename(tmp_egg, eggf)
+			# Forget the contents of the replaced zip, if it was imported from
+			import zipimport
+			zipimport._zip_directory_cache.pop(eggf, None)
+		finally:
+			eggz.close()
+			if os.path.exists(tmpf):
+				shutil.rmtree(tmpf, True)
 
 	@contextmanager
 	def _build_egg_env(self, path):
 		import tempfile, shutil
-		old_cwd = os.getcwd()
-		os.chdir(path)
 		tempdir = tempfile.mkdtemp()
-		yield tempdir
-		shutil.rmtree(tempdir)
-		os.chdir(old_cwd)
+		try:
+			yield tempdir
+		finally:
+			shutil.rmtree(tempdir)
+
+
+def _hash_file(path):
+	h = hashlib.sha256()
+	with open(path, "rb") as f:
+		for chunk in iter(lambda: f.read(65536), ""):
+			h.update(chunk)
+	return h.hexdigest()
+
+def _hash_path(path):
+	if os.path.isdir(path):
+		return _hash_folder(path)
+	return _hash_file(path)
+
+def _hash_folder(folder):
+	h = hashlib.sha256()
+	for (path, dirs, files) in os.walk(folder):
+		dirs.sort()
+		for fn in sorted(files):
+			h.update(os.path.relpath(os.path.join(path, fn), folder) + "\n")
+			h.update(_hash_file(os.path.join(path, fn)) + "\n")
+	return h.hexdigest()
+
+def _is_egg(path):
+	""" Whether the path is an installed egg, either extracted or zipped """
+	if os.path.isdir(path):
+		return os.path.exists(os.path.join(path, "EGG-INFO"))
+	return path.endswith(".egg") and os.path.isfile(path)
+
+def _is_zip_safe(eggz):
+	"""
+	Whether the egg can be imported from the zip file, as flagged by
+	bdist_egg (either from zip_safe in setup.py, or by its own analysis)
+	"""
+	names = eggz.namelist()
+	return "EGG-INFO/zip-safe" in names and not "EGG-INFO/not-zip-safe" in names
 
+def _hash_sources(folder):
+	"""
+	Hashes the source tree of a distribution, leaving out version control
+	and build outputs
+	"""
+	h = hashlib.sha256()
+	for (path, dirs, files) in os.walk(folder):
+		dirs[:] = sorted(d for d in dirs if not d.startswith(".") and
+			d not in ("build", "dist") and not d.endswith(".egg-info"))
+		for fn in sorted(files):
+			if fn.endswith((".pyc", ".pyo")):
+				continue
+			h.update(os.path.relpath(os.path.join(path, fn), folder) + "\n")
+			h.update(_hash_file(os.path.join(path, fn)) + "\n")
+	return h.hexdigest()
@@ -0,0 +1,87 @@
+"""
+Journal of AMI builds. Every state transition of every build target is
+recorded in a local SQLite database, together with the ids of the AWS
+resources involved, so that an interrupted build can be resumed from the
+recorded states.
+"""
+
+import sqlite3, os, os.path, time
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    region TEXT,
+    started REAL,
+    finished REAL
+);
+CREATE TABLE IF NOT EXISTS transitions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id INTEGER,
+    target_id TEXT,
+    stack_name TEXT,
+    base_ami TEXT,
+    last_phase TEXT,
+    state TEXT,
+    result TEXT,
+    stack_id TEXT,
+    instance_id TEXT,
+    ami_id TEXT,
+    error TEXT,
+    time REAL
+);
+CREATE INDEX IF NOT EXISTS transitions_run ON transitions (run_id, target_id, id);
+"""
+
+class BuildJournal(object):
+    """
+    Build journal in the given file. Not to be shared between threads.
+    """
+    def __init__(self, path):
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def start_run(self, region):
+        with self.db:
+            c = self.db.execute("INSERT INTO runs (region, started) VALUES (?, ?)", (region, time.time()))
+        return c.lastrowid
+
+    def finish_run(self, run_id):
+        with self.db:
+            self.db.execute("UPDATE runs SET finished = ? WHERE run_id = ?", (time.time(), run_id))
+
+    def last_unfinished_run(self, region):
+        """ Returns id of the last run in the region that didn't finish, None if there's none """
+        row = self.db.execute("SELECT run_id, finished FROM runs WHERE region = ? ORDER BY run_id DESC LIMIT 1",
+            (region,)).fetchone()
+        if row is None or row['finished'] is not None:
+            return None
+        return row['run_id']
+
+    def record(self, run_id, build_target):
+        """ Records the current state of a build target """
+        target = build_target['target']
+        cfn_stack = build_target.get('cfn_stack')
+        with self.db:
+            self.db.execute("""INSERT INTO transitions (run_id, target_id, stack_name, base_ami, last_phase,
+                    state, result, stack_id, instance_id, ami_id, error, time)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", (
+                run_id, target['target_id'], target['stack_name'], target['base_ami'], target['last_phase'],
+                build_target['state'], build_target.get('result'),
+                cfn_stack is not None and cfn_stack.stack_id or None,
+                build_target.get('instance_id'), build_target.get('ami_id'), build_target.get('error'),
+                time.time()))
+
+    def latest_states(self, run_id):
+        """
+        Returns dictionary target_id -> last recorded transition (a dictionary
+        with the columns of the transitions table)
+        """
+        rows = self.db.execute("""SELECT * FROM transitions WHERE id IN
+            (SELECT MAX(id) FROM transitions WHERE run_id = ? GROUP BY target_id)""", (run_id,))
+        return dict((row['target_id'], dict(zip(row.keys(), row))) for row in rows)
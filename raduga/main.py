@@ -3,26 +3,28 @@ Raduga commands
 
 Usage:
   raduga credentials add [options] <id>
-  raduga module install [options] <path>
+  raduga credentials refresh [options] <id>
+  raduga module install [options] [--jobs=<n>] <path>...
 
 Options:
   -h --help     Show this screen
   -V --verbose  Be verbose
   -D --debug    Be extremely verbose
   --version     Show version
+  --jobs=<n>    Number of modules to build at the same time [default: 4]
 """ 
 
 from docopt import docopt
-import pkg_resources, sys, string
+import sys, string
 import logging
 
-from raduga import Raduga
+from raduga import get_version
 
 log = logging.getLogger()
-version = pkg_resources.require("raduga")[0].version
 
 def main():
-    args = docopt(__doc__, version=version)
+    # Only look up the version (slow) when it's going to be shown
+    args = docopt(__doc__, version="--version" in sys.argv and get_version() or None)
 
     if args['--debug']:
         logging_level = logging.DEBUG
@@ -32,16 +34,21 @@ def main():
         logging_level = logging.WARNING
     logging.basicConfig(stream=sys.stderr, level=logging_level)
 
-    log.info("raduga version %s ( https://github.com/tuxpiper/raduga )" % version)
+    if log.isEnabledFor(logging.INFO):
+        log.info("raduga version %s ( https://github.com/tuxpiper/raduga )" % get_version())
 
     if args['module'] and args['install']:
         from raduga.distmgr import DistributionsManager
         distmgr = DistributionsManager()
-        distmgr.install_dist(args['<path>'])
+        distmgr.install_dists(args['<path>'], int(args['--jobs']))
     elif args['credentials'] and args['add']:
         print "Adding credentials, id: " + args['<id>']
         from raduga.config import config
         from raduga.aws import Credentials
         creds = Credentials.from_interactive()
         config.add_credentials(args['<id>'], creds)
+    elif args['credentials'] and args['refresh']:
+        # Forget cached information derived from the credentials
+        from raduga.config import config
+        config.invalidate_cached(args['<id>'])
 
@@ -2,9 +2,9 @@
 Raduga profile commands
 
 Usage:
-    pcli.py build [options] [--next-only] [<stack> [<stack> ...]]
-    pcli.py deploy [options] [<stack> [<stack> ...]]
-    pcli.py diff [options] [<stack> [<stack> ...]]
+    pcli.py build [options] [--next-only] [--max-stacks=<n>] [--resume] [<stack> [<stack> ...]]
+    pcli.py deploy [options] [--jobs=<n>] [--changed-only] [--wait] [<stack> [<stack> ...]]
+    pcli.py diff [options] [--jobs=<n>] [<stack> [<stack> ...]]
     pcli.py print [options] [<stack> [<stack> ...]]
     pcli.py undeploy [options] [<stack> [<stack> ...]]
     pcli.py update [options] [<stack> [<stack> ...]]
@@ -14,20 +14,30 @@ Options:
     -V --verbose  Be verbose
     -D --debug    Be extremely verbose
     -n --dry-run  Do not actually perform the action
+    --cache       Reuse cached renderings of stacks whose sources didn't change
+    --render-processes=<n>  Number of processes rendering stacks (default: one per cpu)
     --version     Show version
+    --max-stacks=<n>  Maximum number of build stacks running at the same time
+    --resume          Continue the last interrupted build from where it was
+    -j --jobs=<n>     Number of stacks deployed (or diffed) at the same time.
+                      Deploys respect the dependencies between stacks
+    --changed-only    Only deploy stacks whose inputs changed since they were
+                      last deployed from here
+    --wait            Wait for all the deployed stacks to complete, fail if
+                      any of them fails or is rolled back
 """ 
 from docopt import docopt
-import pkg_resources, sys, string
+import sys, string
 import logging
 
-from raduga import Raduga
+from raduga import Raduga, get_version
 
 __doc__ = string.replace(__doc__, "pcli.py", sys.argv[0])
 log = logging.getLogger()
-version = pkg_resources.require("raduga")[0].version
 
 def run(config_fn):
-    args = docopt(__doc__, version=version)
+    # Only look up the version (slow) when it's going to be shown
+    args = docopt(__doc__, version="--version" in sys.argv and get_version() or None)
 
     if args['--debug']:
         logging_level = logging.DEBUG
@@ -37,18 +47,30 @@ def run(config_fn):
         logging_level = logging.WARNING
     logging.basicConfig(stream=sys.stderr, level=logging_level)
 
-    log.info("raduga version %s ( https://github.com/tuxpiper/raduga )" % version)
+    if log.isEnabledFor(logging.INFO):
+        log.info("raduga version %s ( https://github.com/tuxpiper/raduga )" % get_version())
 
     raduga = Raduga()
     config_fn(raduga)
+    if args['--cache']:
+        raduga.use_template_cache = True
+    if args['--render-processes'] is not None:
+        raduga.setRenderOptions(processes=int(args['--render-processes']))
 
     if args['print']:
         raduga.printS(args['<stack>'])
     elif args['deploy']:
-        raduga.deploy(args['<stack>'])
+        if args['--jobs'] is not None:
+            raduga.setDeployOptions(jobs=int(args['--jobs']))
+        raduga.deploy(args['<stack>'], changed_only=args['--changed-only'], wait=args['--wait'])
     elif args['build']:
         build_next = args['--next-only']
-        raduga.build_amis(args['<stack>'], build_next=build_next)
+        if args['--max-stacks'] is not None:
+            raduga.setBuildOptions(max_running_stacks=int(args['--max-stacks']))
+        raduga.build_amis(args['<stack>'], build_next=build_next, resume=args['--resume'])
     elif args['diff']:
-        raduga.diff(args['<stack>'])
+        if args['--jobs'] is not None:
+            raduga.diff(args['<stack>'], jobs=int(args['--jobs']))
+        else:
+            raduga.diff(args['<stack>'])
         
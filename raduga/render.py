@@ -0,0 +1,160 @@
+"""
+Rendered stacks. Once a stack is rendered, its template is all that is
+needed to deploy or diff it, so it can be kept around after the modules
+of the stack have been unloaded, or cached on disk between runs.
+"""
+
+import json, os, os.path, hashlib
+
+class RenderedStack(object):
+    """
+    Stack rendered to its CloudFormation template. It can be used in place
+    of a cloudcast Stack object for deploying or diffing.
+    """
+    def __init__(self, template_json, required_capabilities=[], launchables=None):
+        self.template_json = template_json
+        self.required_capabilities = required_capabilities
+        # Description of the buildable launchables in the stack, each one a
+        # dictionary with "ref_name", "base_ami" and "status_ids" entries
+        self.launchables = launchables
+
+    @classmethod
+    def from_stack(cls, stack, launchables=None):
+        return cls(stack.dump_json(pretty=False), list(stack.required_capabilities), launchables)
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['template_json'], d['required_capabilities'], d['launchables'])
+
+    def to_dict(self):
+        return dict(
+            template_json = self.template_json,
+            required_capabilities = self.required_capabilities,
+            launchables = self.launchables
+        )
+
+    def dump_json(self, pretty=True):
+        if pretty:
+            return json.dumps(json.loads(self.template_json), indent=4, sort_keys=True)
+        return self.template_json
+
+    def get_template(self):
+        return json.loads(self.template_json)
+
+    def fingerprint(self):
+        """ Hash of the rendered template """
+        return hashlib.sha256(self.template_json).hexdigest()
+
+class TemplateCache(object):
+    """
+    On-disk cache of rendered stacks, by key. Keys are expected to capture
+    everything the rendering depends on (see sources_fingerprint)
+    """
+    def __init__(self, folder):
+        self.folder = folder
+
+    def _path(self, key):
+        return os.path.join(self.folder, "%s.json" % key)
+
+    def get(self, key):
+        """ Returns the cached RenderedStack, None if there isn't one """
+        try:
+            with open(self._path(key)) as f:
+                return RenderedStack.from_dict(json.load(f))
+        except (IOError, ValueError, KeyError):
+            return None
+
+    def put(self, key, rendered):
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        # Write and rename, so that readers never see partial entries
+        tmp_path = self._path(key) + ".%d.tmp" % os.getpid()
+        with open(tmp_path, "w") as f:
+            json.dump(rendered.to_dict(), f)
+        os.rename(tmp_path, self._path(key))
+
+class FingerprintStore(object):
+    """
+    Record of the deployed stacks: for each stack, the key of the inputs it
+    was rendered from (see Raduga._render_cache_key) and the fingerprint of
+    the template deployed. Deployments not yet seen to complete also have
+    the "stack_id" of the stack, so that they can be checked later.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._entries = None
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path) as f:
+                    self._entries = json.load(f)
+            except (IOError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def _save(self):
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        tmp_path = self.path + ".%d.tmp" % os.getpid()
+        with open(tmp_path, "w") as f:
+            json.dump(self._entries, f, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def get(self, stack_key):
+        """ Returns dictionary with "inputs", "fingerprint" and "stack_id", or None """
+        return self._load().get(stack_key)
+
+    def put(self, stack_key, inputs, fingerprint, stack_id=None):
+        self._load()[stack_key] = dict(inputs=inputs, fingerprint=fingerprint, stack_id=stack_id)
+        self._save()
+
+    def discard(self, stack_key):
+        if self._load().pop(stack_key, None) is not None:
+            self._save()
+
+def find_module_path(module_name, search_path):
+    """
+    Returns the path to the file (or package folder) of a module, without
+    importing it. None if not found.
+    """
+    import imp
+    path = None
+    for part in module_name.split("."):
+        try:
+            (f, path, _) = imp.find_module(part, search_path)
+        except ImportError:
+            return None
+        if f is not None:
+            f.close()
+        search_path = [ path ]
+    return path
+
+# Folders never taken as sources: raduga's own state and installed modules
+# (these are accounted for by their versions)
+_NOT_SOURCES = ("raduga_modules",)
+
+def sources_fingerprint(paths):
+    """
+    Returns hash of the names, sizes and modification times of the files
+    in the given paths (files or folders, walked recursively). Hidden
+    folders, installed modules and compiled python files are left out.
+    """
+    h = hashlib.sha256()
+    for path in sorted(set(os.path.abspath(p) for p in paths)):
+        if not os.path.exists(path):
+            h.update("%s:missing\n" % path)
+        elif os.path.isdir(path):
+            for (folder, dirs, files) in os.walk(path):
+                dirs[:] = sorted(d for d in dirs if not d.startswith(".") and d not in _NOT_SOURCES)
+                for fn in sorted(files):
+                    _hash_stat(h, os.path.join(folder, fn))
+        else:
+            _hash_stat(h, path)
+    return h.hexdigest()
+
+def _hash_stat(h, path):
+    if path.endswith((".pyc", ".pyo")):
+        return
+    st = os.stat(path)
+    h.update("%s:%d:%d\n" % (path, st.st_size, st.st_mtime))
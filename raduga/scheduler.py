@@ -0,0 +1,146 @@
+"""
+Scheduling helpers. The build scheduler keeps a "next poll at" time for
+each of a set of jobs and advances them, as they become due, on a bounded
+pool of worker threads. The dependency graph tells which jobs can run
+once others are done.
+"""
+
+import logging, time
+from Queue import Queue, Empty
+from multiprocessing.pool import ThreadPool
+
+_log = logging.getLogger(__name__)
+
+class BuildScheduler(object):
+    """
+    Drives a set of state machine jobs until all of them reach a final
+    state. Jobs are dictionaries with (at least) a "state" entry; the
+    transition function receives a job and returns the (possibly new)
+    job dictionary.
+
+    A job whose state changed is polled again right away. A job whose
+    state didn't change is polled again after a delay that grows from
+    min_poll_interval up to max_poll_interval, so long running steps
+    don't keep hammering the APIs.
+
+    If a snapshot function is given, it is called once per poll cycle
+    with the list of jobs about to be advanced, and its return value is
+    passed as second argument to the transition function of each of them.
+    This allows resolving the status of all those jobs in one go.
+
+    If an on_change function is given, it's called with the job id and the
+    job whenever the state of a job changes. It's always called from the
+    thread running the scheduler.
+    """
+    def __init__(self, transition, snapshot=None, workers=8, min_poll_interval=2, max_poll_interval=30, final_state="done",
+                 on_change=None):
+        self.transition = transition
+        self.snapshot = snapshot
+        self.on_change = on_change
+        self.workers = workers
+        self.min_poll_interval = min_poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.final_state = final_state
+
+    def run(self, jobs):
+        """
+        Runs all the jobs (dictionary of job_id -> job) to completion. The
+        dictionary is updated in place and also returned.
+        """
+        now = time.time()
+        next_poll = dict((job_id, now) for job_id in jobs.keys())
+        delays = dict((job_id, 0) for job_id in jobs.keys())
+        running = set()
+        results = Queue()
+        pool = ThreadPool(self.workers)
+        try:
+            while True:
+                pending = [ job_id for (job_id, job) in jobs.items() if job['state'] != self.final_state ]
+                if len(pending) == 0 and len(running) == 0:
+                    break   # All done
+                # Dispatch due jobs, together with those that are about to be
+                # due, so that they share the poll cycle
+                now = time.time()
+                due = [ job_id for job_id in pending if job_id not in running and next_poll[job_id] <= now ]
+                if len(due) > 0:
+                    due = [ job_id for job_id in pending if job_id not in running and
+                            next_poll[job_id] <= now + self.min_poll_interval / 2.0 ]
+                if len(due) > 0:
+                    args = ()
+                    if self.snapshot is not None:
+                        try:
+                            args = (self.snapshot([ jobs[job_id] for job_id in due ]),)
+                        except Exception:
+                            # Try again later, the jobs stay as they are
+                            _log.exception("Error taking status snapshot")
+                            for job_id in due:
+                                next_poll[job_id] = now + self.min_poll_interval
+                            due = []
+                    for job_id in due:
+                        running.add(job_id)
+                        pool.apply_async(self._run_job, (job_id, jobs[job_id], results, args))
+                # Wait for a job to finish, or for the next job to be due
+                waiting = [ next_poll[job_id] for job_id in pending if job_id not in running ]
+                if len(waiting) > 0:
+                    timeout = max(min(waiting) - time.time(), 0.05)
+                else:
+                    timeout = self.max_poll_interval
+                try:
+                    (job_id, old_state, job) = results.get(timeout=timeout)
+                except Empty:
+                    continue
+                running.discard(job_id)
+                jobs[job_id] = job
+                if job['state'] != old_state:
+                    delays[job_id] = 0
+                    if self.on_change is not None:
+                        self.on_change(job_id, job)
+                else:
+                    delays[job_id] = min(max(delays[job_id] * 2, self.min_poll_interval), self.max_poll_interval)
+                next_poll[job_id] = time.time() + delays[job_id]
+        finally:
+            pool.terminate()
+            pool.join()
+        return jobs
+
+    def _run_job(self, job_id, job, results, args):
+        old_state = job['state']
+        try:
+            job = self.transition(job, *args)
+        except Exception as e:
+            # Transition functions are expected to handle their own errors,
+            # this is only the last resort so that other jobs keep going
+            _log.exception("Unhandled error advancing job %s" % job_id)
+            job = dict(job, state=self.final_state, result='FAILED', error=str(e))
+        results.put((job_id, old_state, job))
+
+class DependencyGraph(object):
+    """
+    Dependencies between named jobs. Built from a dictionary name -> names
+    of the jobs it depends on. Dependencies outside of the graph are ignored.
+    """
+    def __init__(self, deps):
+        self.deps = dict((name, set(d for d in dd if d in deps and d != name)) for (name, dd) in deps.items())
+        self.waves()    # check for cycles
+
+    def dependents(self, name):
+        return set(n for (n, dd) in self.deps.items() if name in dd)
+
+    def ready(self, done):
+        """ Jobs not done yet, whose dependencies are all done """
+        return sorted(n for (n, dd) in self.deps.items() if n not in done and dd.issubset(done))
+
+    def waves(self):
+        """
+        Returns list of lists of jobs. Jobs in a wave only depend on jobs
+        in earlier waves.
+        """
+        ret = []
+        done = set()
+        while len(done) < len(self.deps):
+            wave = self.ready(done)
+            if len(wave) == 0:
+                raise RuntimeError("Circular dependencies between %s" % ", ".join(sorted(set(self.deps.keys()) - done)))
+            ret.append(wave)
+            done.update(wave)
+        return ret
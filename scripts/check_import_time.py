@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Checks that importing raduga stays cheap: it must take less than the given
+number of milliseconds (default 50, best of several runs) and must not
+import boto, cloudcast or pkg_resources, which are only loaded by the
+actions that use them.
+
+    python scripts/check_import_time.py [max_ms]
+
+Each import is timed in a fresh interpreter. Exits with status 1 if the
+import is too slow or pulls in any of those modules.
+"""
+
+import json, os, os.path, subprocess, sys
+
+HEAVY_MODULES = [ "boto", "cloudcast", "pkg_resources" ]
+RUNS = 5
+
+_PROBE = """
+import json, sys, time
+t0 = time.time()
+import raduga
+elapsed = time.time() - t0
+print json.dumps(dict(
+    ms = elapsed * 1000,
+    loaded = sorted(m for m in sys.modules if m.split(".")[0] in %r and sys.modules[m] is not None)))
+""" % (HEAVY_MODULES,)
+
+def probe():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([ root ] + [ p for p in [ env.get("PYTHONPATH") ] if p ])
+    out = subprocess.check_output([ sys.executable, "-c", _PROBE ], env=env)
+    return json.loads(out.strip().splitlines()[-1])
+
+def main():
+    max_ms = float(sys.argv[1]) if len(sys.argv) > 1 else 50
+    results = [ probe() for _ in range(RUNS) ]
+    best_ms = min(r["ms"] for r in results)
+    loaded = sorted(set(m for r in results for m in r["loaded"]))
+    print "import raduga: %.1fms (best of %d, limit %.0fms)" % (best_ms, RUNS, max_ms)
+    failed = False
+    if best_ms > max_ms:
+        print "[ERROR] importing raduga is too slow"
+        failed = True
+    if len(loaded) > 0:
+        print "[ERROR] importing raduga loads %s" % ", ".join(loaded)
+        failed = True
+    sys.exit(failed and 1 or 0)
+
+if __name__ == '__main__':
+    main()
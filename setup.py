@@ -12,7 +12,7 @@ setup(
     description = ("Infrastructure-as-code framework for AWS"),
     author = "David Losada Carballo",
     author_email = "david@tuxpiper.com",
-    install_requires = ['cloudcast>=0.1.1', 'docopt>=0.6.1', 'boto>=2.26.1', 'setuptools>=3.3', 'json_tools==0.3.3'],
+    install_requires = ['cloudcast>=0.1.1', 'docopt>=0.6.1', 'boto>=2.26.1', 'setuptools>=3.3'],
     license = 'MIT',
     keywords = "aws internet cloud infrastructure deployment automation",
     long_description = open('README.md').read(),